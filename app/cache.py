@@ -0,0 +1,419 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from hashlib import sha256
+from typing import (Any, Callable, Dict, Iterator, Optional, Protocol, Tuple,
+                    TypeVar)
+
+from app.ranking import tokenize
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class Cache(Protocol):
+    def get(self, key: str) -> Optional[str]: ...
+
+    def set(self, key: str, value: str) -> None: ...
+
+    def stats(self) -> dict: ...
+
+
+class TTLCache:
+    """LRU cache bounded by the total size of its values in bytes.
+
+    Entries expire ttl seconds after they were set. With keep_expired, expired
+    entries stay until they are evicted for space and can still be read with
+    get(key, allow_expired=True). When persist_path is given the cache is loaded
+    from that JSON file, and written to it by save() or save_async() when it changed.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, persist_path: Optional[str] = None, keep_expired: bool = False) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self.keep_expired = keep_expired
+        self.entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        if persist_path:
+            self.load()
+
+    def get(self, key: str, allow_expired: bool = False) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.time() and not allow_expired:
+            if not self.keep_expired:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        """Whether get(key) would hit, without counting it or changing the LRU order."""
+        entry = self.entries.get(key)
+        return entry is not None and entry[0] >= time.time()
+
+    def set(self, key: str, value: str) -> None:
+        value_size = len(value.encode())
+        if value_size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.size += value_size
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+        self.dirty = True
+
+    def _remove(self, key: str) -> None:
+        _, value = self.entries.pop(key)
+        self.size -= len(value.encode())
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def load(self) -> None:
+        if not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r") as file:
+                stored = json.load(file)
+        except (OSError, ValueError):
+            logger.exception(f"Failed to load cache from {self.persist_path}")
+            return
+        now = time.time()
+        for key, (expires_at, value) in stored.items():
+            if expires_at > now:
+                self.entries[key] = (expires_at, value)
+                self.size += len(value.encode())
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def save(self) -> None:
+        if self.persist_path and self.dirty:
+            self.dirty = False
+            self._write(dict(self.entries))
+
+    async def save_async(self) -> None:
+        """Like save(), with the file written in a thread so the event loop is not blocked."""
+        if self.persist_path and self.dirty:
+            self.dirty = False
+            await asyncio.to_thread(self._write, dict(self.entries))
+
+    def _write(self, entries: dict) -> None:
+        tmp_path = f"{self.persist_path}.tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                file.write(json.dumps(entries))
+            os.replace(tmp_path, self.persist_path)
+        except OSError:
+            self.dirty = True
+            logger.exception(f"Failed to persist cache to {self.persist_path}")
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class DocumentCache:
+    """Values derived from metadata documents, such as parsed indexes, keyed by a hash of the document.
+
+    Bounded by the total size in bytes of the documents the values were derived
+    from, least recently used first. Concurrent requests for one value wait for a
+    single derivation, which runs outside the lock, so lookups of other documents
+    are not held up; derive is meant to run in a worker thread.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Tuple[int, Any]]" = OrderedDict()
+        self.size = 0
+        self._deriving: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind: str, document: str, derive: Callable[[str], T]) -> T:
+        key = f"{kind}:{sha256(document.encode()).hexdigest()}"
+        while True:
+            with self._lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    return self.entries[key][1]
+                deriving = self._deriving.get(key)
+                if deriving is None:
+                    deriving = self._deriving[key] = threading.Event()
+                    break
+            deriving.wait()
+        try:
+            value = derive(document)
+            size = len(document.encode())
+            with self._lock:
+                self.entries[key] = (size, value)
+                self.size += size
+                while self.size > self.max_bytes and len(self.entries) > 1:
+                    self.size -= self.entries.popitem(last=False)[1][0]
+        finally:
+            with self._lock:
+                del self._deriving[key]
+            deriving.set()
+        return value
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes}
+
+
+class SqliteCache:
+    """SQLite backed cache with the same semantics as TTLCache.
+
+    The database file can be shared by several worker processes. Writes and
+    access times are applied in batches by a background thread, so set() and
+    get() do not wait for the database lock; until a write is committed it is
+    answered from memory. The total size is kept up to date by triggers, and
+    least recently used entries are only looked up when it exceeds max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl: float, flush_interval: float = 1.0) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+        self.connection = self._connect()
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT, size INTEGER, expires_at REAL, accessed_at REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)")
+            self.connection.execute("INSERT OR IGNORE INTO usage (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM entries")
+            self.connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS entries_inserted AFTER INSERT ON entries "
+                "BEGIN UPDATE usage SET total = total + NEW.size; END"
+            )
+            self.connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS entries_deleted AFTER DELETE ON entries "
+                "BEGIN UPDATE usage SET total = total - OLD.size; END"
+            )
+            self.connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS entries_resized AFTER UPDATE OF size ON entries "
+                "BEGIN UPDATE usage SET total = total - OLD.size + NEW.size; END"
+            )
+        # Writes not committed yet, by key: (value, size, expires_at, accessed_at)
+        self.pending: Dict[str, Tuple[str, int, float, float]] = {}
+        self.accessed: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, name=f"sqlite-cache-{os.path.basename(path)}", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            pending = self.pending.get(key)
+        if pending is not None and pending[2] > now:
+            value = pending[0]
+        else:
+            row = self.connection.execute(
+                "SELECT value FROM entries WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            value = row[0] if row is not None else None
+        if value is None:
+            self.misses += 1
+            return None
+        with self._lock:
+            self.accessed[key] = now
+        self.hits += 1
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        now = time.time()
+        with self._lock:
+            pending = self.pending.get(key)
+        if pending is not None and pending[2] > now:
+            return True
+        return self.connection.execute("SELECT 1 FROM entries WHERE key = ? AND expires_at > ?", (key, now)).fetchone() is not None
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self.pending[key] = (value, size, now + self.ttl, now)
+        self._wake.set()
+
+    def flush(self) -> None:
+        """Commit pending writes and access times, evicting entries when over max_bytes."""
+        with self._write_lock:
+            with self._lock:
+                written = dict(self.pending)
+                accessed, self.accessed = self.accessed, {}
+            if not written and not accessed:
+                return
+            connection = self._writer_connection
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.executemany(
+                    "INSERT INTO entries (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, "
+                    "expires_at = excluded.expires_at, accessed_at = excluded.accessed_at",
+                    [(key, *entry) for key, entry in written.items()],
+                )
+                connection.executemany(
+                    "UPDATE entries SET accessed_at = MAX(accessed_at, ?) WHERE key = ?",
+                    [(accessed_at, key) for key, accessed_at in accessed.items()],
+                )
+                self._evict(connection)
+            with self._lock:
+                for key, entry in written.items():
+                    if self.pending.get(key) is entry:
+                        del self.pending[key]
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        total = connection.execute("SELECT total FROM usage").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        connection.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+        excess = connection.execute("SELECT total FROM usage").fetchone()[0] - self.max_bytes
+        evicted = []
+        # The accessed_at index yields the least recently used entries first, only as many as needed
+        for key, size in connection.execute("SELECT key, size FROM entries ORDER BY accessed_at"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+    def _write_loop(self) -> None:
+        self._writer_connection = self._connect()
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                logger.exception(f"Failed to write cache entries to {self.path}")
+
+    def close(self) -> None:
+        """Stop the writer thread after committing what is pending."""
+        self._closed = True
+        self._wake.set()
+        self._writer.join()
+        self.flush()
+
+    def most_recent(self, max_bytes: int) -> Iterator[Tuple[str, str]]:
+        """Unexpired entries, most recently used first, up to max_bytes in total."""
+        total = 0
+        rows = self.connection.execute(
+            "SELECT key, value, size FROM entries WHERE expires_at > ? ORDER BY accessed_at DESC", (time.time(),)
+        )
+        for key, value, size in rows:
+            total += size
+            if total > max_bytes:
+                break
+            yield key, value
+
+    def clear(self) -> None:
+        with self._write_lock:
+            with self._lock:
+                self.pending.clear()
+                self.accessed.clear()
+            self.connection.execute("DELETE FROM entries")
+
+    def stats(self) -> dict:
+        entries, size = self.connection.execute("SELECT (SELECT COUNT(*) FROM entries), total FROM usage").fetchone()
+        return {
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def normalize_question(question: str) -> str:
+    """Fold case, punctuation and whitespace so trivially different questions share a cache entry."""
+    question = unicodedata.normalize("NFKC", question).casefold()
+    question = re.sub(r"[^\w\s]", " ", question)
+    return " ".join(question.split())
+
+
+class QuestionCache:
+    """Cache of pipeline results keyed by normalized question.
+
+    With similarity_threshold > 0, a question whose terms overlap (cosine) with a
+    previously cached question at least that much reuses its entry. Numbers such as
+    years always have to match exactly.
+    """
+
+    def __init__(self, backend: Cache, similarity_threshold: float = 0.0, max_questions: int = 1000) -> None:
+        self.backend = backend
+        self.similarity_threshold = similarity_threshold
+        self.max_questions = max_questions
+        self.questions: "OrderedDict[str, set]" = OrderedDict()
+
+    def canonical(self, question: str) -> str:
+        normalized = normalize_question(question)
+        if self.similarity_threshold <= 0 or normalized in self.questions:
+            return normalized
+        terms = set(tokenize(normalized))
+        numbers = {term for term in terms if term.isdigit()}
+        best, best_score = normalized, self.similarity_threshold
+        for known, known_terms in self.questions.items():
+            if not terms or not known_terms or numbers != {term for term in known_terms if term.isdigit()}:
+                continue
+            score = len(terms & known_terms) / (len(terms) * len(known_terms)) ** 0.5
+            if score >= best_score:
+                best, best_score = known, score
+        return best
+
+    def remember(self, question: str) -> None:
+        normalized = normalize_question(question)
+        self.questions[normalized] = set(tokenize(normalized))
+        self.questions.move_to_end(normalized)
+        if len(self.questions) > self.max_questions:
+            self.questions.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        return self.backend.get(key)
+
+    def set(self, key: str, value: str, question: Optional[str] = None) -> None:
+        self.backend.set(key, value)
+        if question is not None and self.similarity_threshold > 0:
+            self.remember(question)
+
+    def stats(self) -> dict:
+        return self.backend.stats()
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from hashlib import sha256
+from typing import Optional
+
+import SPARQLWrapper
+
+from app.lib import CUBES_QUERY
+from app.ranking import CubeIndex
+from app.resilience import detached_task
+from app.singleflight import SingleFlight
+from app.sparql import SparqlClient, get_client
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CatalogSnapshot:
+    text: str
+    version: str
+    etag: Optional[str]
+    fetched_at: float
+    changed_at: float
+    index: CubeIndex
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+
+class CatalogService:
+    """In-memory BAFU cube catalog, refreshed in the background.
+
+    Readers always get the current snapshot immediately (stale-while-revalidate).
+    A refresh only bumps the version when the endpoint ETag or the content hash changes.
+    """
+
+    def __init__(self, refresh_interval: float = 3600.0, client: Optional[SparqlClient] = None) -> None:
+        self.refresh_interval = refresh_interval
+        self.client = client
+        self.snapshot: Optional[CatalogSnapshot] = None
+        self._refresh_lock = asyncio.Lock()
+        self._flights = SingleFlight()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        try:
+            await self.refresh()
+        except Exception:
+            logger.exception("Initial catalog load failed, will retry on first request")
+        self._loop_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        for task in (self._loop_task, self._refresh_task):
+            if task is not None:
+                task.cancel()
+
+    async def get(self) -> str:
+        if self.snapshot is None:
+            await self.refresh()
+        elif self.snapshot.age > self.refresh_interval:
+            self._schedule_refresh()
+        return self.snapshot.text
+
+    async def get_index(self) -> CubeIndex:
+        await self.get()
+        return self.snapshot.index
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.snapshot.version if self.snapshot else None
+
+    async def refresh(self) -> bool:
+        """Reload the catalog, returns True when its content changed.
+
+        Concurrent callers, e.g. every request arriving before the first load, share one fetch.
+        """
+        return await self._flights.do("refresh", self._refresh)
+
+    async def _refresh(self) -> bool:
+        async with self._refresh_lock:
+            client = self.client or get_client()
+            etag = self.snapshot.etag if self.snapshot else None
+            response = await client.fetch(CUBES_QUERY, return_format=SPARQLWrapper.N3, etag=etag)
+            now = time.time()
+
+            if response.not_modified:
+                self.snapshot.fetched_at = now
+                return False
+
+            version = sha256(response.body.encode()).hexdigest()[:16]
+            if self.snapshot is not None and self.snapshot.version == version:
+                self.snapshot.fetched_at = now
+                self.snapshot.etag = response.etag
+                return False
+
+            await self._load(response.body, version, response.etag)
+            return True
+
+    async def load(self, text: str) -> None:
+        """Use a catalog obtained elsewhere (e.g. the local mirror), until the next refresh."""
+        async with self._refresh_lock:
+            await self._load(text, sha256(text.encode()).hexdigest()[:16], etag=None)
+
+    async def _load(self, text: str, version: str, etag: Optional[str]) -> None:
+        now = time.time()
+        index = await asyncio.to_thread(CubeIndex.from_n3, text)
+        self.snapshot = CatalogSnapshot(
+            text=text,
+            version=version,
+            etag=etag,
+            fetched_at=now,
+            changed_at=now,
+            index=index,
+        )
+        logger.info(f"Catalog updated to version {version}")
+
+    def _schedule_refresh(self) -> None:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = detached_task(self._safe_refresh())
+
+    async def _safe_refresh(self) -> None:
+        try:
+            await self.refresh()
+        except Exception:
+            logger.exception("Catalog refresh failed, serving stale catalog")
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self._safe_refresh()
+
+    def status(self) -> dict:
+        if self.snapshot is None:
+            return {"loaded": False}
+        return {
+            "loaded": True,
+            "version": self.snapshot.version,
+            "cubes": len(self.snapshot.index.cubes),
+            "etag": self.snapshot.etag,
+            "age_seconds": round(self.snapshot.age, 1),
+            "fetched_at": self.snapshot.fetched_at,
+            "changed_at": self.snapshot.changed_at,
+            "refreshing": self._refresh_lock.locked(),
+        }
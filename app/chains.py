@@ -0,0 +1,43 @@
+from typing import Callable, Dict, Optional, Tuple
+
+import aiohttp
+import openai
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chains import LLMChain
+
+
+class ChainRegistry:
+    """Builds each LLM chain once per settings combination and reuses it for all requests.
+
+    Chains are stateless between calls (callbacks are passed per invocation), so one
+    instance can serve concurrent requests. All OpenAI calls share one aiohttp session.
+    """
+
+    def __init__(self, api_key: str, handler: BaseCallbackHandler, max_connections: int = 50) -> None:
+        self.api_key = api_key
+        self.handler = handler
+        self.max_connections = max_connections
+        self.chains: Dict[Tuple, LLMChain] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def get(self, factory: Callable[..., LLMChain], **settings) -> LLMChain:
+        key = (factory.__name__, tuple(sorted(settings.items())))
+        chain = self.chains.get(key)
+        if chain is None:
+            chain = factory(api_key=self.api_key, handler=self.handler, **settings)
+            self.chains[key] = chain
+        return chain
+
+    async def start(self) -> None:
+        connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    def bind_session(self) -> None:
+        """Make OpenAI requests in the current context use the shared session."""
+        if self.session is not None:
+            openai.aiosession.set(self.session)
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
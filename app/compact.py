@@ -0,0 +1,189 @@
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Set
+
+from rdflib import RDF, BNode, Graph, Literal, URIRef
+
+from app.ranking import CUBE, SCHEMA, CubeInfo
+
+KNOWN_PREFIXES = {
+    "cube": "https://cube.link/",
+    "schema": "http://schema.org/",
+    "sh": "http://www.w3.org/ns/shacl#",
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
+    "xsd": "http://www.w3.org/2001/XMLSchema#",
+    "qudt": "http://qudt.org/schema/qudt/",
+    "dct": "http://purl.org/dc/terms/",
+}
+
+LOCAL_NAME = re.compile(r"^[\w](?:[\w\-.]*[\w\-])?$")
+MIN_NAMESPACE_USES = 2
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Token count with the OpenAI tokenizer, or an estimate when it is not available offline."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+def _split_namespace(iri: str) -> Optional[str]:
+    cut = max(iri.rfind("/"), iri.rfind("#"))
+    if cut <= 0 or cut == len(iri) - 1:
+        return None
+    return iri[:cut + 1]
+
+
+def _derive_prefixes(graph: Graph) -> Dict[str, str]:
+    """Known prefixes plus generated ones for namespaces used at least MIN_NAMESPACE_USES times."""
+    prefixes = dict(KNOWN_PREFIXES)
+    known = set(prefixes.values())
+    uses = Counter(
+        _split_namespace(str(term))
+        for triple in graph
+        for term in triple
+        if isinstance(term, URIRef)
+    )
+    for namespace, count in sorted(uses.items(), key=lambda item: (-item[1], item[0] or "")):
+        if namespace is None or namespace in known or count < MIN_NAMESPACE_USES:
+            continue
+        segment = re.sub(r"[^A-Za-z0-9_]", "_", namespace.rstrip("/#").rsplit("/", 1)[-1]) or "ns"
+        prefix = segment if segment[0].isalpha() else f"ns_{segment}"
+        suffix = 1
+        while prefix in prefixes:
+            suffix += 1
+            prefix = f"{segment}{suffix}"
+        prefixes[prefix] = namespace
+        known.add(namespace)
+    return prefixes
+
+
+class _Renderer:
+    def __init__(self, prefixes: Dict[str, str], full_iris: Set[URIRef]) -> None:
+        self.by_namespace = {namespace: prefix for prefix, namespace in prefixes.items()}
+        self.prefixes = prefixes
+        self.full_iris = full_iris
+        self.used = set()
+
+    def term(self, term) -> str:
+        if isinstance(term, URIRef):
+            if term == RDF.type:
+                return "a"
+            if term in self.full_iris:
+                return f"<{term}>"
+            iri = str(term)
+            namespace = _split_namespace(iri)
+            prefix = self.by_namespace.get(namespace)
+            local = iri[len(namespace):] if namespace else ""
+            if prefix is not None and LOCAL_NAME.match(local):
+                self.used.add(prefix)
+                return f"{prefix}:{local}"
+            return f"<{iri}>"
+        if isinstance(term, Literal):
+            text = '"%s"' % str(term).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            if term.language:
+                return f"{text}@{term.language}"
+            if term.datatype:
+                return f"{text}^^{self.term(term.datatype)}"
+            return text
+        if isinstance(term, BNode):
+            return f"_:{term}"
+        return str(term)
+
+    def header(self) -> str:
+        return "\n".join(f"PREFIX {prefix}: <{self.prefixes[prefix]}>" for prefix in sorted(self.used))
+
+
+def compact_graph(graph: Graph, budget: int) -> str:
+    """Render graph as a prefixed outline, one block per subject, within a token budget.
+
+    Subjects are ordered deterministically (cubes first, then by IRI) and the ones
+    that do not fit in the budget are dropped and counted in a trailing comment.
+    Cube IRIs are kept in full since they are copied verbatim into answers and queries.
+    """
+    cubes = set(graph.subjects(RDF.type, CUBE.Cube))
+    renderer = _Renderer(_derive_prefixes(graph), full_iris=cubes)
+    by_subject = defaultdict(lambda: defaultdict(list))
+    for subject, predicate, obj in graph:
+        by_subject[subject][predicate].append(obj)
+
+    subjects = sorted(by_subject, key=lambda subject: (subject not in cubes, str(subject)))
+
+    blocks: List[str] = []
+    for subject in subjects:
+        properties = by_subject[subject]
+        lines = []
+        for predicate in sorted(properties, key=lambda predicate: (predicate != RDF.type, str(predicate))):
+            objects = ", ".join(renderer.term(obj) for obj in sorted(properties[predicate], key=str))
+            lines.append(f"{renderer.term(predicate)} {objects}")
+        if len(lines) == 1:
+            blocks.append(f"{renderer.term(subject)} {lines[0]}")
+        else:
+            blocks.append("\n".join([renderer.term(subject)] + [f"  {line}" for line in lines]))
+
+    # Prefixes used by the blocks are only known after rendering, reserve room for all of them
+    used_tokens = count_tokens(renderer.header())
+    kept: List[str] = []
+    for block in blocks:
+        block_tokens = count_tokens(block) + 1
+        if used_tokens + block_tokens > budget and kept:
+            break
+        kept.append(block)
+        used_tokens += block_tokens
+
+    text = renderer.header() + "\n\n" + "\n".join(kept)
+    omitted = len(blocks) - len(kept)
+    if omitted:
+        text += f"\n# ... {omitted} more subjects omitted"
+    return text
+
+
+def compact_cubes(cubes: List[CubeInfo], budget: int) -> str:
+    """Render cubes with their labels and descriptions, within a token budget where possible.
+
+    Every cube keeps its full IRI and its label, since the LLM can only choose cubes it
+    has seen, so the labels alone may exceed the budget of a very large catalog.
+    Descriptions are kept in the given order (best match first) while they fit in the
+    budget, the cubes listed without one are counted in a trailing comment.
+    """
+    iris = [URIRef(cube.iri.strip("<>")) for cube in cubes]
+    renderer = _Renderer(dict(KNOWN_PREFIXES), full_iris=set(iris))
+    labelled: List[str] = []
+    described: List[str] = []
+    for iri, cube in zip(iris, cubes):
+        subject = renderer.term(iri)
+        name = f"{renderer.term(SCHEMA.name)} {renderer.term(Literal(cube.label, lang='en'))}"
+        description = f"{renderer.term(SCHEMA.description)} {renderer.term(Literal(cube.description, lang='en'))}"
+        labelled.append(f"{subject} {name}")
+        described.append(f"{subject}\n  {name}\n  {description}")
+
+    used_tokens = count_tokens(renderer.header()) + sum(count_tokens(line) + 1 for line in labelled)
+    kept = 0
+    for short, full in zip(labelled, described):
+        extra_tokens = count_tokens(full) - count_tokens(short)
+        if used_tokens + extra_tokens > budget:
+            break
+        used_tokens += extra_tokens
+        kept += 1
+
+    text = renderer.header() + "\n\n" + "\n".join(described[:kept] + labelled[kept:])
+    omitted = len(cubes) - kept
+    if omitted:
+        text += f"\n# ... {omitted} cubes listed without their description"
+    return text
+
+
+def compact_n3(n3: str, budget: int) -> str:
+    graph = Graph()
+    graph.parse(data=n3, format="turtle")
+    return compact_graph(graph, budget)
@@ -0,0 +1,150 @@
+import difflib
+import math
+import threading
+import unicodedata
+from collections import defaultdict
+from dataclasses import dataclass, field
+from hashlib import sha256
+from typing import Callable, Dict, List, Optional, Set
+
+from rdflib import Graph, Literal, URIRef
+
+from app.cache import DocumentCache, TTLCache
+from app.compact import compact_graph, count_tokens
+from app.ranking import SCHEMA, tokenize
+
+# Question terms missing from the index are matched to index terms at least this similar
+FUZZY_CUTOFF = 0.85
+SUMMARY_EXAMPLES = 3
+# Links each value to its dimension in the fetched dimension labels. It is not a LINDAS
+# predicate, so it is only read for indexing and never rendered into prompts.
+DIMENSION_OF = URIRef("urn:llm-playground:dimension")
+
+
+def fold(text: str) -> str:
+    """Lowercase text without diacritics, so "Zurich" matches "Zürich"."""
+    return "".join(char for char in unicodedata.normalize("NFKD", text.lower()) if not unicodedata.combining(char))
+
+
+@dataclass
+class DimensionValue:
+    iri: URIRef
+    label: Literal
+    dimensions: Set[URIRef] = field(default_factory=set)
+
+
+class DimensionIndex:
+    """Inverted index over the value labels of the dimensions of one cube.
+
+    Values are grouped by the dimension they belong to (DIMENSION_OF in the
+    dimension labels). Question terms are stemmed and diacritics folded, and
+    terms that are not in the index are matched to close index terms, so small
+    typos and spelling variants still find their value.
+    """
+
+    def __init__(self, values: List[DimensionValue]) -> None:
+        self.values = values
+        self.by_dimension: Dict[Optional[URIRef], List[int]] = defaultdict(list)
+        self.postings: Dict[str, Set[int]] = defaultdict(set)
+        for value_id, value in enumerate(values):
+            for dimension in value.dimensions or {None}:
+                self.by_dimension[dimension].append(value_id)
+            for term in tokenize(fold(str(value.label))):
+                self.postings[term].add(value_id)
+        self.terms = sorted(self.postings)
+        self.idf = {term: math.log(1 + len(values) / len(ids)) for term, ids in self.postings.items()}
+
+    @classmethod
+    def from_n3(cls, n3: str) -> "DimensionIndex":
+        graph = Graph()
+        graph.parse(data=n3, format="turtle")
+        values = []
+        for value, label in sorted(graph.subject_objects(SCHEMA.name)):
+            values.append(DimensionValue(iri=value, label=label, dimensions=set(graph.objects(value, DIMENSION_OF))))
+        return cls(values)
+
+    def _question_terms(self, question: str) -> Set[str]:
+        terms = set()
+        for term in tokenize(fold(question)):
+            if term in self.postings:
+                terms.add(term)
+            elif len(term) >= 4:
+                terms.update(difflib.get_close_matches(term, self.terms, n=2, cutoff=FUZZY_CUTOFF))
+        return terms
+
+    def match(self, question: str, max_values: int) -> List[DimensionValue]:
+        """Values whose labels share terms with the question, most specific matches first."""
+        scores: Dict[int, float] = defaultdict(float)
+        for term in self._question_terms(question):
+            for value_id in self.postings[term]:
+                scores[value_id] += self.idf[term]
+        ranked = sorted(scores, key=lambda value_id: (-scores[value_id], str(self.values[value_id].label)))
+        return [self.values[value_id] for value_id in ranked[:max_values]]
+
+    def relevant(self, question: str, budget: int, max_values: int = 50, full_values: int = 20) -> str:
+        """Dimension labels for the prompt: a summary of every dimension and only the values relevant to question.
+
+        Dimensions with at most full_values values are listed completely, larger ones
+        only with the values matching the question, so the size of the result does
+        not depend on the size of the code lists.
+        """
+        listed = {id(value) for value in self.match(question, max_values)}
+        graph = Graph()
+        summary = []
+        for dimension, value_ids in sorted(self.by_dimension.items(), key=lambda item: str(item[0] or "")):
+            values = [self.values[value_id] for value_id in value_ids]
+            shown = values if len(values) <= full_values else [value for value in values if id(value) in listed]
+            for value in shown:
+                graph.add((value.iri, SCHEMA.name, value.label))
+            name = f"<{dimension}>" if dimension is not None else "Other dimensions"
+            line = f"# {name}: {len(values)} values, {len(shown)} listed"
+            if len(shown) < len(values):
+                examples = ", ".join(f'"{value.label}"' for value in values[:SUMMARY_EXAMPLES])
+                line += f", others are like {examples}"
+            summary.append(line)
+        summary_text = "\n".join(summary)
+        return summary_text + "\n" + compact_graph(graph, budget - count_tokens(summary_text))
+
+    def labels(self, budget: int) -> str:
+        """Labels of all values, for prompts that get the whole code lists."""
+        graph = Graph()
+        for value in self.values:
+            graph.add((value.iri, SCHEMA.name, value.label))
+        return compact_graph(graph, budget)
+
+
+class DimensionIndexCache:
+    """Indexes of dimension label documents and their renderings for recent questions.
+
+    Indexes are kept in a DocumentCache shared with other metadata derived values,
+    renderings up to a quarter of its size. Building an index and rendering are
+    slow for large code lists and meant to run in a worker thread.
+    """
+
+    def __init__(self, documents: DocumentCache, ttl: float) -> None:
+        self.documents = documents
+        self.renderings = TTLCache(max_bytes=documents.max_bytes // 4, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def index(self, dimensions_n3: str) -> DimensionIndex:
+        return self.documents.get("dimension_index", dimensions_n3, DimensionIndex.from_n3)
+
+    def relevant(self, dimensions_n3: str, question: str, budget: int, max_values: int = 50, full_values: int = 20) -> str:
+        """DimensionIndex.relevant of the document, reused for questions with the same terms."""
+        terms = " ".join(sorted(set(tokenize(fold(question)))))
+        key = f"{budget}-{max_values}-{full_values}-{terms}-{dimensions_n3}"
+        return self._rendered(key, lambda: self.index(dimensions_n3).relevant(question, budget, max_values=max_values, full_values=full_values))
+
+    def labels(self, dimensions_n3: str, budget: int) -> str:
+        """DimensionIndex.labels of the document."""
+        return self._rendered(f"{budget}-{dimensions_n3}", lambda: self.index(dimensions_n3).labels(budget))
+
+    def _rendered(self, key: str, render: Callable[[], str]) -> str:
+        key = sha256(key.encode()).hexdigest()
+        with self._lock:
+            rendered = self.renderings.get(key)
+        if rendered is None:
+            rendered = render()
+            with self._lock:
+                self.renderings.set(key, rendered)
+        return rendered
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import re
+import time
+from hashlib import md5
+from typing import AsyncIterator, List, Optional, Tuple
+
+import SPARQLWrapper
+
+from app.cache import Cache
+from app.metrics import record_cache, span
+from app.sparql import SparqlClient, get_client
+
+CODE_BLOCK = re.compile(r"```(?:sparql)?\s*\n(.*?)```", re.DOTALL | re.IGNORECASE)
+STRING_LITERAL = re.compile(r"(\"\"\".*?\"\"\"|'''.*?'''|\"(?:[^\"\\\n]|\\.)*\"|'(?:[^'\\\n]|\\.)*')", re.DOTALL)
+PROLOGUE = re.compile(r"^\s*(?:(?:PREFIX\s+[\w\-.]*:\s*<[^>]*>|BASE\s*<[^>]*>)\s*)*", re.IGNORECASE)
+SOLUTION_MODIFIERS = re.compile(r"(?:\s+(?:LIMIT|OFFSET)\s+\d+)+\s*$", re.IGNORECASE)
+LIMIT = re.compile(r"\bLIMIT\s+(\d+)", re.IGNORECASE)
+OFFSET = re.compile(r"\bOFFSET\s+(\d+)", re.IGNORECASE)
+ORDER_BY = re.compile(r"\bORDER\s+BY\b", re.IGNORECASE)
+
+
+class QueryNotExecutable(ValueError):
+    pass
+
+
+def extract_query(text: str) -> str:
+    """Query text of an LLM response, without a surrounding markdown code block."""
+    block = CODE_BLOCK.search(text)
+    return (block.group(1) if block else text).strip()
+
+
+def normalize_query(query: str) -> str:
+    """Collapse whitespace outside of string literals, so formatting differences share a cache entry."""
+    parts = STRING_LITERAL.split(query.strip())
+    # Odd parts are the literals matched by the capturing group
+    return "".join(part if index % 2 else " ".join(part.split()) for index, part in enumerate(parts))
+
+
+def query_form(query: str) -> str:
+    body = PROLOGUE.sub("", query)
+    match = re.match(r"\s*(\w+)", body)
+    return match.group(1).upper() if match else ""
+
+
+def split_paging(query: str) -> Tuple[str, int, Optional[int]]:
+    """Split trailing LIMIT/OFFSET clauses off a query, returning (query, offset, limit)."""
+    modifiers = SOLUTION_MODIFIERS.search(query)
+    if modifiers is None:
+        return query, 0, None
+    clauses = modifiers.group(0)
+    limit = LIMIT.search(clauses)
+    offset = OFFSET.search(clauses)
+    return (
+        query[:modifiers.start()],
+        int(offset.group(1)) if offset else 0,
+        int(limit.group(1)) if limit else None,
+    )
+
+
+def is_ordered(query: str) -> bool:
+    """Whether the outer query has an ORDER BY clause, i.e. its rows come in the same order every time."""
+    # Solution modifiers of the outer query follow its last closing brace
+    body = STRING_LITERAL.sub('""', query)
+    return ORDER_BY.search(body[body.rfind("}") + 1:]) is not None
+
+
+class QueryExecutor:
+    """Runs generated queries against the SPARQL endpoint and streams their results.
+
+    SELECT queries with ORDER BY are fetched in LIMIT/OFFSET pages of page_size rows,
+    so neither the endpoint response nor the result set is materialized as a whole.
+    Without ORDER BY the row order may differ between requests, so pages could
+    repeat or skip rows and the query is fetched in one request instead. At most
+    max_rows rows are returned and paging stops once timeout seconds have passed.
+    Complete result sets are cached by normalized query text.
+    """
+
+    def __init__(self, cache: Cache, page_size: int = 1000, max_rows: int = 10000, timeout: float = 60.0, client: Optional[SparqlClient] = None) -> None:
+        self.cache = cache
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.client = client
+
+    def cache_key(self, query: str) -> str:
+        return md5(f"{self.page_size}-{self.max_rows}-{normalize_query(query)}".encode()).hexdigest()
+
+    async def execute(self, query: str) -> AsyncIterator[dict]:
+        """Yield the result head, then one message per page of bindings, then a summary."""
+        query = extract_query(query)
+        form = query_form(query)
+        if form not in ("SELECT", "ASK"):
+            raise QueryNotExecutable(f"Only SELECT and ASK queries can be executed, got {form or 'no query'}")
+
+        key = self.cache_key(query)
+        cached = self.cache.get(key)
+        record_cache("results", cached is not None)
+        if cached is not None:
+            result = json.loads(cached)
+            yield {"head": result["head"], "cached": True}
+            if "boolean" in result:
+                yield {"boolean": result["boolean"]}
+            for start in range(0, len(result["rows"]), self.page_size):
+                yield {"bindings": result["rows"][start:start + self.page_size]}
+            yield {"done": True, "rows": len(result["rows"]), "truncated": result["truncated"], "timed_out": False, "cached": True}
+            return
+
+        client = self.client or get_client()
+        if form == "ASK":
+            with span("execute"):
+                response = await asyncio.wait_for(client.query(query, SPARQLWrapper.JSON), self.timeout)
+            head = response.get("head", {})
+            yield {"head": head}
+            yield {"boolean": response.get("boolean")}
+            yield {"done": True, "rows": 0, "truncated": False, "timed_out": False}
+            self.cache.set(key, json.dumps({"head": head, "boolean": response.get("boolean"), "rows": [], "truncated": False}))
+            return
+
+        base, offset, limit = split_paging(query)
+        wanted = self.max_rows if limit is None else min(limit, self.max_rows)
+        deadline = time.monotonic() + self.timeout
+        page_size = self.page_size if is_ordered(base) else max(wanted, 1)
+
+        def fetch_page(page_offset: int) -> asyncio.Task:
+            page_query = f"{base}\nLIMIT {min(page_size, offset + wanted - page_offset)} OFFSET {page_offset}"
+            return asyncio.create_task(client.query(page_query, SPARQLWrapper.JSON))
+
+        rows: List[dict] = []
+        head_sent = False
+        timed_out = False
+        page_offset = offset
+        page = fetch_page(page_offset)
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    with span("execute", offset=page_offset):
+                        response = await asyncio.wait_for(page, max(remaining, 0))
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    break
+                bindings = response.get("results", {}).get("bindings", [])
+                page_offset += len(bindings)
+                more = len(bindings) == page_size and page_offset < offset + wanted
+                # The next page is requested while the current one is sent to the client
+                page = fetch_page(page_offset) if more else None
+                if not head_sent:
+                    yield {"head": response.get("head", {})}
+                    head_sent = True
+                rows.extend(bindings)
+                for start in range(0, max(len(bindings), 1), self.page_size):
+                    yield {"bindings": bindings[start:start + self.page_size]}
+                if not more:
+                    break
+        finally:
+            if page is not None and not page.done():
+                page.cancel()
+
+        truncated = timed_out or (len(rows) >= self.max_rows and (limit is None or limit > self.max_rows))
+        if not head_sent:
+            yield {"head": {}}
+        yield {"done": True, "rows": len(rows), "truncated": truncated, "timed_out": timed_out}
+        if not timed_out:
+            self.cache.set(key, json.dumps({"head": response.get("head", {}), "rows": rows, "truncated": truncated}))
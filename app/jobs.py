@@ -0,0 +1,114 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from app.cache import Cache
+from app.lib import error_detail
+from app.metrics import JOBS, JOBS_QUEUED, log_trace, start_trace
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """Runs question pipelines submitted as jobs on a pool of background workers.
+
+    Job records are stored as JSON in a cache under the job id, so they expire
+    with the cache TTL and, with a SQLite backed cache, can be polled from any
+    worker process. The queue itself is in-process: a job runs in the process
+    that accepted it, and a queued or running job older than stale_after seconds
+    is assumed lost with its process and runs again when it is resubmitted.
+    Jobs queued or running in this process are also kept in memory, since the
+    cache may evict their records before they finish.
+    """
+
+    def __init__(self, store: Cache, run: Callable[[dict], Awaitable[dict]], workers: int = 4, max_queue: int = 1000, stale_after: float = 600.0, on_start: Optional[Callable[[], None]] = None) -> None:
+        self.store = store
+        self.run = run
+        self.workers = workers
+        self.stale_after = stale_after
+        self.on_start = on_start
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._active: Dict[str, dict] = {}
+        self._finished: Dict[str, asyncio.Event] = {}
+        self._worker_tasks: List[asyncio.Task] = []
+
+    async def start(self) -> None:
+        self._worker_tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._worker_tasks:
+            task.cancel()
+
+    def get(self, job_id: str) -> Optional[dict]:
+        if job_id in self._active:
+            return dict(self._active[job_id])
+        record = self.store.get(job_id)
+        return json.loads(record) if record is not None else None
+
+    def _save(self, job: dict) -> None:
+        self.store.set(job["id"], json.dumps(job))
+
+    def submit(self, job_id: str, request: dict) -> dict:
+        """Queue a job, or return the existing one with the same id unless it failed or is stale.
+
+        Raises asyncio.QueueFull when max_queue jobs are waiting.
+        """
+        if job_id in self._active:
+            return dict(self._active[job_id])
+        existing = self.get(job_id)
+        if existing is not None:
+            stale = existing["status"] in ("queued", "running") and existing["submitted_at"] < time.time() - self.stale_after
+            if existing["status"] == "failed" or stale:
+                existing = None
+        if existing is not None:
+            return existing
+        job = {"id": job_id, "status": "queued", "request": request, "submitted_at": time.time()}
+        self.queue.put_nowait(job)
+        self._active[job_id] = job
+        self._finished[job_id] = asyncio.Event()
+        self._save(job)
+        JOBS_QUEUED.set(self.queue.qsize())
+        return job
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        """The job once it is finished, or as it is after timeout seconds."""
+        finished = self._finished.get(job_id)
+        if finished is not None:
+            job = self._active[job_id]
+            try:
+                await asyncio.wait_for(finished.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return dict(job)
+        # Jobs of other worker processes are only visible through the store
+        deadline = time.monotonic() + timeout
+        job = self.get(job_id)
+        while job is not None and job["status"] in ("queued", "running") and time.monotonic() < deadline:
+            await asyncio.sleep(min(0.5, max(deadline - time.monotonic(), 0)))
+            job = self.get(job_id)
+        return job
+
+    async def _work(self) -> None:
+        if self.on_start is not None:
+            self.on_start()
+        while True:
+            job = await self.queue.get()
+            JOBS_QUEUED.set(self.queue.qsize())
+            job.update(status="running", started_at=time.time())
+            self._save(job)
+            with start_trace(job["id"]) as trace:
+                try:
+                    job.update(status="done", result=await self.run(job["request"]))
+                except Exception as e:
+                    logger.exception(f"Job {job['id']} failed")
+                    job.update(status="failed", error=error_detail(e))
+                job["finished_at"] = time.time()
+                log_trace(trace, job=job["id"], status=job["status"], duration_ms=round(1000 * (job["finished_at"] - job["started_at"]), 1))
+            self._save(job)
+            JOBS.inc(result=job["status"])
+            self._active.pop(job["id"], None)
+            finished = self._finished.pop(job["id"], None)
+            if finished is not None:
+                finished.set()
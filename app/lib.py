@@ -1,22 +1,74 @@
+import asyncio
+import json
+import random
 import re
-from typing import Any, Dict, Optional, Union
+import time
+from collections import defaultdict
+from typing import (Any, AsyncIterator, Awaitable, Callable, Container, Dict,
+                    List, Optional, Tuple, TypeVar, Union)
 
+import openai
 import SPARQLWrapper
-from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
 from langchain.chains import LLMChain
 from langchain.chat_models import ChatOpenAI
-from langchain.prompts.chat import ChatPromptTemplate
-from langchain.schema import AgentAction, AgentFinish
+from langchain.schema import AgentAction, AgentFinish, LLMResult
+
+from app.dimensions import DIMENSION_OF
+from app.metrics import cached_tokens, record_tokens
+from app.prompts import PromptLayer, layered_prompt
+from app.sparql import SparqlClient, get_client
+
+T = TypeVar("T")
+
+RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout)
+
+
+QUERY_RULES = """
+    You are a SPARQL query generator. Generate only the SPARQL query without any additional text or explanations.
+    Important rules for query generation:
+    1. Do not add any explanatory text before or after the query
+    2. Do not wrap the output in code blocks or sparql tags
+    3. The query should start directly with the PREFIX declarations
+    4. COUNT, SUM, AVG, MIN, MAX functions can only be used in the same line as SELECT. Do not use them anywhere else.
+    5. For aggregations (COUNT, SUM, AVG, MIN, MAX), rename variable using this exact pattern:
+    (SUM(?a) AS ?sum_a)
+    (COUNT(?a) AS ?count_a)
+    (AVG(?a) AS ?avg_a)
+    (MIN(?a) AS ?min_a)
+    (MAX(?a) AS ?max_a)
+
+    6. For year/time filtering, use these exact patterns based on the type of time constraint:
+
+    For a specific year range:
+    FILTER(?year >= "2005"^^xsd:gYear && ?year <= "2007"^^xsd:gYear)
+
+    For years after a specific year:
+    FILTER(?year >= "2003"^^xsd:gYear)
+
+    For years before a specific year:
+    FILTER(?year <= "2005"^^xsd:gYear)
+
+    For a specific year:
+    FILTER(?year = "2004"^^xsd:gYear)
+
+    7. If you extract year from date, follow this exact pattern:
+    BIND(STRDT(STR(YEAR(?date)), xsd:gYear) AS ?year)
+    """
 
 
 class LoggingHandler(BaseCallbackHandler):
     """Callback Handler that writes logger"""
 
+    # Run in the caller's context instead of an executor thread, so spans of the current request are visible
+    run_inline = True
+
     def __init__(
         self, logger
     ) -> None:
         """Initialize callback handler."""
         self.logger = logger
+        self.started: Dict[Any, float] = {}
 
     def __del__(self) -> None:
         """Destructor to cleanup when done."""
@@ -27,11 +79,25 @@ class LoggingHandler(BaseCallbackHandler):
     ) -> None:
         """Print out that we are entering a chain."""
         class_name = serialized.get("name", serialized.get("id", ["<unknown>"])[-1])
+        self.started[kwargs.get("run_id")] = time.perf_counter()
         self.logger.info(f"Entering new {class_name} chain...")
 
     def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
         """Print out that we finished a chain."""
-        self.logger.info(f"Finished chain.")
+        started = self.started.pop(kwargs.get("run_id"), None)
+        elapsed = f" in {time.perf_counter() - started:.2f}s" if started is not None else ""
+        self.logger.info(f"Finished chain{elapsed}.")
+
+    def on_chain_error(self, error: BaseException, **kwargs: Any) -> None:
+        """Forget the start time of a failed chain."""
+        self.started.pop(kwargs.get("run_id"), None)
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        """Log and record token usage."""
+        token_usage = (response.llm_output or {}).get("token_usage")
+        if token_usage:
+            self.logger.info(f"Token usage: prompt={token_usage.get('prompt_tokens')}, completion={token_usage.get('completion_tokens')}, cached={cached_tokens(token_usage)}")
+            record_tokens(token_usage)
 
     def on_agent_action(
         self, action: AgentAction, color: Optional[str] = None, **kwargs: Any
@@ -67,17 +133,44 @@ class LoggingHandler(BaseCallbackHandler):
         self.logger.info(finish.log)
 
 
-def run_query(query: str, return_format: str = SPARQLWrapper.JSON):
-    sparql = SPARQLWrapper.SPARQLWrapper(endpoint="https://lindas.admin.ch/query")
-    sparql.setReturnFormat(return_format)
-    sparql.setHTTPAuth(SPARQLWrapper.DIGEST)
-    sparql.setMethod(SPARQLWrapper.POST)
-    sparql.setQuery(query)
-    return sparql.queryAndConvert()
+class CubePrefetchHandler(AsyncCallbackHandler):
+    """Callback Handler that reports cube IDs as soon as they appear in a streamed response"""
+
+    def __init__(self, on_cube: Callable[[str], Any], max_cubes: int = 2) -> None:
+        self.on_cube = on_cube
+        self.max_cubes = max_cubes
+        self.text = ""
+        self.seen: list[str] = []
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Parse the response so far and report new cubes."""
+        self.text += token
+        for cube in parse_all_cubes(self.text):
+            if len(self.seen) >= self.max_cubes:
+                return
+            if cube not in self.seen:
+                self.seen.append(cube)
+                self.on_cube(cube)
+
+
+class TokenQueueHandler(AsyncCallbackHandler):
+    """Callback Handler that puts streamed LLM tokens into a queue"""
+
+    def __init__(self, queue: asyncio.Queue) -> None:
+        self.queue = queue
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Forward a new token."""
+        if token:
+            self.queue.put_nowait(token)
+
+
+async def run_query(query: str, return_format: str = SPARQLWrapper.JSON, client: Optional[SparqlClient] = None):
+    client = client or get_client()
+    return await client.query(query, return_format=return_format)
 
 
-def fetch_cubes_descriptions() -> str:
-    cubes_query = """
+CUBES_QUERY = """
         PREFIX cube: <https://cube.link/>
         PREFIX sh: <http://www.w3.org/ns/shacl#>
         PREFIX schema: <http://schema.org/>
@@ -105,84 +198,168 @@ def fetch_cubes_descriptions() -> str:
                 ?cube schema:expires ?date .
             }
         }
-    """
-
-    raw_result = run_query(cubes_query, return_format=SPARQLWrapper.N3)
-    return raw_result.decode()
+"""
 
 
-def create_cube_selection_chain(api_key: str, handler: BaseCallbackHandler, temperature: float = 0.5, top_p: float = 0.5) -> LLMChain:
-    cube_selection_model = ChatOpenAI(openai_api_key=api_key, model="gpt-4o-mini", temperature=temperature, top_p=top_p)
+async def fetch_cubes_descriptions(client: Optional[SparqlClient] = None) -> str:
+    return await run_query(CUBES_QUERY, return_format=SPARQLWrapper.N3, client=client)
 
-    cubes_description = """
-    Given following data cubes with its labels and description:
-    {cubes}
-    """
 
-    human_template = """
-    For this question: {question}
-    Return the cube ID that best answers this question. Justify your answer.
+def create_cube_selection_chain(api_key: str, handler: BaseCallbackHandler, temperature: float = 0.5, top_p: float = 0.5, streaming: bool = False, model_name: str = "gpt-4o-mini") -> LLMChain:
+    # The answer is only a few IRIs, a small max_tokens keeps a runaway answer cheap
+    cube_selection_model = ChatOpenAI(openai_api_key=api_key, model=model_name, temperature=temperature, top_p=top_p, streaming=streaming, max_tokens=150, callbacks=[handler])
 
-    If no cube matches even with these mandatory rules, return 'Unable to select proper cube'.
-    List all topics that ARE available in the cubes. Format the available topics as a list ith bullet points.
+    system_instructions = """
+    You select the data cubes that answer a question.
+    Return only the IDs of the cubes that answer the question, best match first, one per line, in angle brackets.
+    Return at most 3 cube IDs and no other text.
 
+    If no cube matches, return NONE.
     """
 
-    cube_selection_prompt = ChatPromptTemplate.from_messages([
-        ("system", cubes_description),
-        ("human", human_template),
-    ])
+    cube_selection_prompt = layered_prompt(
+        (PromptLayer.STATIC, "system", system_instructions),
+        (PromptLayer.CATALOG, "system", "{catalog}"),
+        (PromptLayer.QUESTION, "human", "{candidates}{question}"),
+    )
 
     cube_selection_chain = LLMChain(prompt=cube_selection_prompt, llm=cube_selection_model, callbacks=[handler])
 
     return cube_selection_chain
 
 
-def create_query_generation_chain(api_key: str, handler: BaseCallbackHandler, temperature: float = 0.2, top_p: float = 0.1) -> LLMChain:
-    model = ChatOpenAI(openai_api_key=api_key, model="gpt-4o-mini", temperature=temperature, top_p=top_p)
+def create_cube_selection_function_chain(api_key: str, handler: BaseCallbackHandler, temperature: float = 0.5, top_p: float = 0.5, model_name: str = "gpt-4o-mini") -> LLMChain:
+    """Cube selection answered through a function call, see select_cubes_with_function."""
+    cube_selection_model = ChatOpenAI(openai_api_key=api_key, model=model_name, temperature=temperature, top_p=top_p, max_tokens=150, callbacks=[handler])
 
-    sample_description = """
-    Given cube and its sample observation::
-    {cube_and_sample}
+    system_instructions = """
+    You select the data cubes that answer a question.
+    Select the cubes that answer the question, best match first, each with a relevance score between 0 and 1.
+    If no cube matches, select none.
     """
 
-    structure_description = """
-    Dimensions labels:
-    {dimensions_triplets}
+    cube_selection_prompt = layered_prompt(
+        (PromptLayer.STATIC, "system", system_instructions),
+        (PromptLayer.CATALOG, "system", "{catalog}"),
+        (PromptLayer.QUESTION, "human", "{candidates}{question}"),
+    )
+
+    return LLMChain(prompt=cube_selection_prompt, llm=cube_selection_model, callbacks=[handler])
+
+
+def cube_selection_inputs(question: str, cubes: str, ranked: bool) -> Dict[str, str]:
+    """Inputs of the cube selection prompts for compacted cube descriptions.
+
+    The whole catalog only changes with the catalog version and goes into the
+    catalog message, where providers can cache it. Cubes ranked for the question
+    go into the question message, so the catalog message stays the same.
     """
+    if ranked:
+        return {
+            "catalog": "The data cubes to choose from are given with the question.",
+            "candidates": f"Given following data cubes with its labels and description:\n{cubes}\n\nQuestion: ",
+            "question": question,
+        }
+    return {
+        "catalog": f"Given following data cubes with its labels and description:\n{cubes}",
+        "candidates": "",
+        "question": question,
+    }
+
+
+def cube_selection_function(cube_iris: List[str], max_cubes: int = 3) -> dict:
+    """Function schema whose arguments can only name the given cubes."""
+    return {
+        "name": "select_cubes",
+        "description": "Select the cubes that answer the question",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "cubes": {
+                    "type": "array",
+                    "maxItems": max_cubes,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "cube": {"type": "string", "enum": cube_iris},
+                            "score": {"type": "number", "minimum": 0, "maximum": 1},
+                        },
+                        "required": ["cube"],
+                    },
+                },
+            },
+            "required": ["cubes"],
+        },
+    }
+
+
+def parse_cube_selection(arguments: str, known_cubes: Container[str]) -> List[Tuple[str, float]]:
+    """Cubes and scores of select_cubes arguments, best first, dropping cubes that are not in the catalog."""
+    try:
+        selected = json.loads(arguments).get("cubes", [])
+    except (ValueError, AttributeError):
+        return []
+    cubes: Dict[str, float] = {}
+    for rank, item in enumerate(selected if isinstance(selected, list) else []):
+        if not isinstance(item, dict) or not isinstance(item.get("cube"), str):
+            continue
+        cube = f"<{item['cube'].strip().strip('<>')}>"
+        score = item.get("score")
+        if cube in known_cubes and cube not in cubes:
+            cubes[cube] = float(score) if isinstance(score, (int, float)) else 1.0 - rank / 10
+    # Stable sort keeps the model's order for equal scores
+    return sorted(cubes.items(), key=lambda item: item[1], reverse=True)
+
+
+def cube_selection_llm_kwargs(cube_iris: List[str], max_cubes: int = 3) -> Dict[str, Any]:
+    """Model arguments forcing a select_cubes function call."""
+    function = cube_selection_function(cube_iris, max_cubes)
+    return {"functions": [function], "function_call": {"name": function["name"]}}
+
+
+async def select_cubes_with_function(chain: LLMChain, inputs: Dict[str, Any], cube_iris: List[str], known_cubes: Container[str], max_cubes: int = 3) -> List[Tuple[str, float]]:
+    model = chain.llm.bind(**cube_selection_llm_kwargs(cube_iris, max_cubes))
+    message = await (chain.prompt | model).ainvoke(inputs)
+    function_call = message.additional_kwargs.get("function_call") or {}
+    return parse_cube_selection(function_call.get("arguments", ""), known_cubes)
+
+
+def create_cube_explanation_chain(api_key: str, handler: BaseCallbackHandler, temperature: float = 0.2, top_p: float = 0.1, model_name: str = "gpt-4o-mini") -> LLMChain:
+    model = ChatOpenAI(openai_api_key=api_key, model=model_name, temperature=temperature, top_p=top_p, callbacks=[handler])
 
     system_instructions = """
-    You are a SPARQL query generator. Generate only the SPARQL query without any additional text or explanations.
-    Important rules for query generation:
-    1. Do not add any explanatory text before or after the query
-    2. Do not wrap the output in code blocks or sparql tags
-    3. The query should start directly with the PREFIX declarations
-    4. COUNT, SUM, AVG, MIN, MAX functions can only be used in the same line as SELECT. Do not use them anywhere else.
-    5. For aggregations (COUNT, SUM, AVG, MIN, MAX), rename variable using this exact pattern:
-    (SUM(?a) AS ?sum_a)
-    (COUNT(?a) AS ?count_a)
-    (AVG(?a) AS ?avg_a)
-    (MIN(?a) AS ?min_a)
-    (MAX(?a) AS ?max_a)
+    Explain in two or three sentences why the given data cube answers the question, or what it is missing.
+    """
 
-    6. For year/time filtering, use these exact patterns based on the type of time constraint:
+    cube_description = """
+    Given this data cube with its label and description:
+    {cube_description}
+    """
 
-    For a specific year range:
-    FILTER(?year >= "2005"^^xsd:gYear && ?year <= "2007"^^xsd:gYear)
+    prompt = layered_prompt(
+        (PromptLayer.STATIC, "system", system_instructions),
+        (PromptLayer.CUBE, "system", cube_description),
+        (PromptLayer.QUESTION, "human", "{question}"),
+    )
 
-    For years after a specific year:
-    FILTER(?year >= "2003"^^xsd:gYear)
+    return LLMChain(prompt=prompt, llm=model, callbacks=[handler])
 
-    For years before a specific year:
-    FILTER(?year <= "2005"^^xsd:gYear)
 
-    For a specific year:
-    FILTER(?year = "2004"^^xsd:gYear)
+def create_query_generation_chain(api_key: str, handler: BaseCallbackHandler, temperature: float = 0.2, top_p: float = 0.1, streaming: bool = False, model_name: str = "gpt-4o-mini") -> LLMChain:
+    model = ChatOpenAI(openai_api_key=api_key, model=model_name, temperature=temperature, top_p=top_p, streaming=streaming, callbacks=[handler])
 
-    7. If you extract year from date, follow this exact pattern:
-    BIND(STRDT(STR(YEAR(?date)), xsd:gYear) AS ?year)
+    sample_description = """
+    Given cube and its sample observation::
+    {cube_and_sample}
+    """
+
+    structure_description = """
+    Dimensions labels:
+    {dimensions_triplets}
     """
 
+    system_instructions = QUERY_RULES
+
     query_template = """
     PREFIX cube: <https://cube.link/>
     PREFIX schema: <http://schema.org/>
@@ -203,20 +380,138 @@ def create_query_generation_chain(api_key: str, handler: BaseCallbackHandler, te
     ?observation a cube:Observation.
     }}
     """
-    human_template = f"Modify this query: {query_template}\n to get {{question}} for this cube {{cube}}"
+    # Dimension labels are narrowed down to the question, so they belong to the question message
+    human_template = structure_description + "\n    Modify the query template to get {question} for this cube {cube}"
+
+    prompt = layered_prompt(
+        (PromptLayer.STATIC, "system", system_instructions),
+        (PromptLayer.CUBE, "system", sample_description),
+        (PromptLayer.CUBE, "system", f"Query template for this cube:\n{query_template}"),
+        (PromptLayer.QUESTION, "human", human_template),
+    )
+
+    chain = LLMChain(prompt=prompt, llm=model, callbacks=[handler])
+
+    return chain
+
+
+def create_query_repair_chain(api_key: str, handler: BaseCallbackHandler, temperature: float = 0.2, top_p: float = 0.1, model_name: str = "gpt-4o-mini") -> LLMChain:
+    model = ChatOpenAI(openai_api_key=api_key, model=model_name, temperature=temperature, top_p=top_p, callbacks=[handler])
+
+    sample_description = """
+    Given cube and its sample observation::
+    {cube_and_sample}
+    """
+
+    structure_description = """
+    Dimensions labels:
+    {dimensions_triplets}
+    """
+
+    human_template = structure_description + """
+    This query was generated to get {question} for this cube {cube}:
+    {query}
 
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", sample_description),
-        ("system", structure_description),
-        ("human", human_template),
-        ("system", system_instructions),
-    ])
+    It has the following problems:
+    {errors}
+
+    Fix these problems and return the corrected query. Keep everything else unchanged.
+    """
+
+    prompt = layered_prompt(
+        (PromptLayer.STATIC, "system", QUERY_RULES),
+        (PromptLayer.CUBE, "system", sample_description),
+        (PromptLayer.QUESTION, "human", human_template),
+    )
 
     chain = LLMChain(prompt=prompt, llm=model, callbacks=[handler])
 
     return chain
 
 
+async def call_with_backoff(fn: Callable[[], Awaitable[T]], max_retries: int = 5, base_delay: float = 1.0) -> T:
+    """Retry fn on rate limit and availability errors with exponential backoff and jitter.
+
+    Honours the Retry-After header when the provider sends one.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return await fn()
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            retry_after = (getattr(e, "headers", None) or {}).get("retry-after")
+            delay = float(retry_after) if retry_after else base_delay * 2 ** attempt
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+
+async def run_question_batch(
+    questions: List[str],
+    select_cube: Callable[[str], Awaitable[str]],
+    fetch_metadata: Callable[[str], Awaitable[Any]],
+    generate_query: Callable[[str, str], Awaitable[str]],
+    concurrency: int = 8,
+    max_retries: int = 5,
+) -> AsyncIterator[Dict[str, Any]]:
+    """Run the full pipeline for many questions, yielding results as they complete.
+
+    Cubes are selected for all questions first, then questions are grouped by cube
+    so the metadata of each cube is fetched once before its queries are generated.
+    At most `concurrency` LLM calls run at the same time.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def limited(fn: Callable[[], Awaitable[T]]) -> T:
+        async with semaphore:
+            return await call_with_backoff(fn, max_retries=max_retries)
+
+    async def select(index: int, question: str) -> Optional[str]:
+        try:
+            return await limited(lambda: select_cube(question))
+        except Exception as e:
+            results.put_nowait({"index": index, "question": question, "error": error_detail(e)})
+            return None
+
+    async def generate(index: int, question: str, cube: str) -> None:
+        try:
+            query = await limited(lambda: generate_query(question, cube))
+            results.put_nowait({"index": index, "question": question, "cube": cube, "query": query})
+        except Exception as e:
+            results.put_nowait({"index": index, "question": question, "cube": cube, "error": error_detail(e)})
+
+    async def generate_group(cube: str, members: List[int]) -> None:
+        try:
+            await fetch_metadata(cube)
+        except Exception as e:
+            for index in members:
+                results.put_nowait({"index": index, "question": questions[index], "cube": cube, "error": error_detail(e)})
+            return
+        await asyncio.gather(*(generate(index, questions[index], cube) for index in members))
+
+    async def run() -> None:
+        try:
+            cubes = await asyncio.gather(*(select(index, question) for index, question in enumerate(questions)))
+            groups = defaultdict(list)
+            for index, cube in enumerate(cubes):
+                if cube is not None:
+                    groups[cube].append(index)
+            await asyncio.gather(*(generate_group(cube, members) for cube, members in groups.items()))
+        finally:
+            results.put_nowait(None)
+
+    task = asyncio.create_task(run())
+    try:
+        while (result := await results.get()) is not None:
+            yield result
+        await task
+    finally:
+        task.cancel()
+
+
+def error_detail(error: Exception) -> Any:
+    return getattr(error, "detail", None) or str(error) or type(error).__name__
+
 
 def parse_all_cubes(ai_response: str) -> list[str]:
     words = ai_response.split()
@@ -226,7 +521,7 @@ def parse_all_cubes(ai_response: str) -> list[str]:
     return [f'<{cube}>' for group in groups_of_cubes for cube in group]
 
 
-def fetch_cube_sample(cube: str) -> str:
+async def fetch_cube_sample(cube: str, client: Optional[SparqlClient] = None) -> str:
     query = f"""
         PREFIX cube: <https://cube.link/>
         PREFIX sh: <http://www.w3.org/ns/shacl#>
@@ -257,11 +552,10 @@ def fetch_cube_sample(cube: str) -> str:
         }}
     """
 
-    raw_result = run_query(query, return_format=SPARQLWrapper.N3)
-    return raw_result.decode()
+    return await run_query(query, return_format=SPARQLWrapper.N3, client=client)
 
 
-def fetch_dimensions_triplets(cube: str) -> str:
+async def fetch_dimensions_triplets(cube: str, client: Optional[SparqlClient] = None) -> str:
     query = f"""
         PREFIX cube: <https://cube.link/>
         PREFIX sh: <http://www.w3.org/ns/shacl#>
@@ -271,10 +565,11 @@ def fetch_dimensions_triplets(cube: str) -> str:
         PREFIX qudt: <http://qudt.org/schema/qudt/>
 
         CONSTRUCT {{
-        ?values schema:name ?label.
+        ?values schema:name ?label;
+            <{DIMENSION_OF}> ?dimensions.
         }}
         WHERE {{
-            SELECT ?values ?label
+            SELECT ?values ?label ?dimensions
             WHERE {{
                 VALUES ?cube {{ {cube} }}
 
@@ -296,5 +591,4 @@ def fetch_dimensions_triplets(cube: str) -> str:
         }}
     """
 
-    raw_result = run_query(query, return_format=SPARQLWrapper.N3)
-    return raw_result.decode()
+    return await run_query(query, return_format=SPARQLWrapper.N3, client=client)
@@ -0,0 +1,78 @@
+import json
+import logging
+from hashlib import sha256
+from typing import Any, Optional
+
+from langchain.chains import LLMChain
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema.cache import RETURN_VAL_TYPE, BaseCache
+
+from app.cache import SqliteCache, TTLCache
+from app.metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+
+class LLMResponseCache(BaseCache):
+    """Durable langchain LLM cache, used for every chain through langchain.llm_cache.
+
+    Keys hash the fully rendered prompt together with the model and its settings
+    (temperature, top_p, functions, ...). Responses are stored in SQLite, so they
+    survive restarts and are shared by workers, with a small in-memory LRU in front.
+    """
+
+    def __init__(self, backend: SqliteCache, memory: TTLCache) -> None:
+        self.backend = backend
+        self.memory = memory
+
+    @staticmethod
+    def key(prompt: str, llm_string: str) -> str:
+        return sha256(f"{llm_string}\0{prompt}".encode()).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self.key(prompt, llm_string)
+        value = self.memory.get(key)
+        if value is None:
+            value = self.backend.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        record_cache("llm", value is not None)
+        if value is None:
+            return None
+        try:
+            return [loads(generation) for generation in json.loads(value)]
+        except Exception:
+            logger.warning(f"Ignoring unreadable LLM cache entry {key}")
+            return None
+
+    def contains(self, chain: LLMChain, inputs: dict, **llm_kwargs: Any) -> bool:
+        """Whether calling chain with inputs would be answered from this cache.
+
+        llm_kwargs are the arguments bound to the model for the call, e.g. functions.
+        The key is built the way langchain's chat models build it for their lookup.
+        """
+        prompt = dumps(chain.prompt.format_messages(**inputs))
+        key = self.key(prompt, chain.llm._get_llm_string(**llm_kwargs))
+        return key in self.memory or key in self.backend
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        key = self.key(prompt, llm_string)
+        value = json.dumps([dumps(generation) for generation in return_val])
+        self.memory.set(key, value)
+        self.backend.set(key, value)
+
+    def clear(self, **kwargs: Any) -> None:
+        self.memory.clear()
+        self.backend.clear()
+
+    def warm_up(self) -> int:
+        """Load the most recently used responses into memory, returns how many were loaded."""
+        entries = list(self.backend.most_recent(self.memory.max_bytes))
+        # Oldest first, so the most recently used entries end up last in the LRU order
+        for key, value in reversed(entries):
+            self.memory.set(key, value)
+        return len(entries)
+
+    def stats(self) -> dict:
+        return {**self.backend.stats(), "memory": self.memory.stats()}
@@ -1,43 +1,178 @@
+import asyncio
+import json
 import logging
+import math
 import os
-from collections import OrderedDict
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from hashlib import md5
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
 
+import aiohttp
+import langchain
 from fastapi import FastAPI, Form, HTTPException, Request
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import (FileResponse, HTMLResponse, JSONResponse,
+                               PlainTextResponse, StreamingResponse)
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from langchain.chains import LLMChain
 from pydantic import BaseModel
 
-from app.lib import (LoggingHandler, create_cube_selection_chain,
-                     create_query_generation_chain, fetch_cube_sample,
-                     fetch_cubes_descriptions, fetch_dimensions_triplets,
-                     parse_all_cubes)
+from app.cache import DocumentCache, QuestionCache, SqliteCache, TTLCache
+from app.catalog import CatalogService
+from app.chains import ChainRegistry
+from app.compact import compact_cubes, compact_n3
+from app.dimensions import DimensionIndexCache
+from app.execute import QueryExecutor, QueryNotExecutable
+from app.jobs import JobQueue
+from app.lib import (CubePrefetchHandler, LoggingHandler, TokenQueueHandler,
+                     create_cube_explanation_chain,
+                     create_cube_selection_chain,
+                     create_cube_selection_function_chain,
+                     create_query_generation_chain,
+                     create_query_repair_chain, cube_selection_inputs,
+                     cube_selection_llm_kwargs, error_detail,
+                     parse_all_cubes, run_question_batch,
+                     select_cubes_with_function)
+from app.llm_cache import LLMResponseCache
+from app.metadata import CubeMetadataCache
+from app.metrics import (CUBE_ROUTES, LLM_FALLBACKS, QUERY_VALIDATIONS,
+                         REQUEST_SECONDS, log_trace, record_cache,
+                         record_prompt_prefix, render, setup_opentelemetry,
+                         span, start_trace)
+from app.mirror import MetadataMirror
+from app.prompts import prefix_hash
+from app.ranking import CubeIndex
+from app.resilience import (CircuitBreaker, CircuitOpen, LatencyTracker,
+                            hedged, set_deadline, stage_timeout)
+from app.scheduler import (LLMScheduler, Overloaded, Priority, estimate_tokens,
+                           set_priority)
+from app.singleflight import SingleFlight
+from app.sparql import LINDAS_ENDPOINT, SparqlClient, set_client
+from app.validation import clean_query, validate_query
 
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+SPARQL_ENDPOINT = os.environ.get("SPARQL_ENDPOINT", LINDAS_ENDPOINT)
+SPARQL_MAX_CONNECTIONS = int(os.environ.get("SPARQL_MAX_CONNECTIONS", 20))
+SPARQL_MAX_CONCURRENCY = int(os.environ.get("SPARQL_MAX_CONCURRENCY", 10))
+SPARQL_TIMEOUT = float(os.environ.get("SPARQL_TIMEOUT", 30))
+CATALOG_REFRESH_INTERVAL = float(os.environ.get("CATALOG_REFRESH_INTERVAL", 3600))
+METADATA_CACHE_TTL = float(os.environ.get("METADATA_CACHE_TTL", 86400))
+METADATA_CACHE_MAX_BYTES = int(os.environ.get("METADATA_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+METADATA_CACHE_PATH = os.environ.get("METADATA_CACHE_PATH")
+METADATA_CACHE_SAVE_INTERVAL = float(os.environ.get("METADATA_CACHE_SAVE_INTERVAL", 60))
+CUBE_PREFETCH_COUNT = int(os.environ.get("CUBE_PREFETCH_COUNT", 2))
+CUBE_CANDIDATES = int(os.environ.get("CUBE_CANDIDATES", 15))
+PROMPT_CATALOG_TOKENS = int(os.environ.get("PROMPT_CATALOG_TOKENS", 4000))
+PROMPT_SAMPLE_TOKENS = int(os.environ.get("PROMPT_SAMPLE_TOKENS", 1500))
+PROMPT_DIMENSIONS_TOKENS = int(os.environ.get("PROMPT_DIMENSIONS_TOKENS", 3000))
+DIMENSION_VALUES_MAX = int(os.environ.get("DIMENSION_VALUES_MAX", 50))
+DIMENSION_VALUES_FULL = int(os.environ.get("DIMENSION_VALUES_FULL", 20))
+DIMENSION_INDEX_MAX_BYTES = int(os.environ.get("DIMENSION_INDEX_MAX_BYTES", 16 * 1024 * 1024))
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get("LLM_REQUESTS_PER_MINUTE", 500))
+LLM_TOKENS_PER_MINUTE = float(os.environ.get("LLM_TOKENS_PER_MINUTE", 200000))
+LLM_QUEUE_MAX = int(os.environ.get("LLM_QUEUE_MAX", 100))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", 10.0))
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", 60))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 30))
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", 0.95))
+LLM_FALLBACK_MODEL = os.environ.get("LLM_FALLBACK_MODEL", "")
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get("CIRCUIT_BREAKER_FAILURES", 5))
+CIRCUIT_BREAKER_RESET = float(os.environ.get("CIRCUIT_BREAKER_RESET", 30))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_QUEUE_MAX = int(os.environ.get("JOB_QUEUE_MAX", 1000))
+# Longest a GET /jobs/{id} request waits for the job to finish
+JOB_MAX_WAIT = 60.0
+QUESTION_CACHE_BACKEND = os.environ.get("QUESTION_CACHE_BACKEND", "memory")
+QUESTION_CACHE_PATH = os.environ.get("QUESTION_CACHE_PATH", "question_cache.sqlite")
+QUESTION_CACHE_TTL = float(os.environ.get("QUESTION_CACHE_TTL", 7 * 86400))
+QUESTION_CACHE_MAX_BYTES = int(os.environ.get("QUESTION_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+QUESTION_CACHE_SIMILARITY = float(os.environ.get("QUESTION_CACHE_SIMILARITY", 0))
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", "llm_cache.sqlite")
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", 30 * 86400))
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+LLM_CACHE_MEMORY_BYTES = int(os.environ.get("LLM_CACHE_MEMORY_BYTES", 16 * 1024 * 1024))
+LLM_CACHE_WARM_UP = os.environ.get("LLM_CACHE_WARM_UP", "1").lower() in ("1", "true", "yes")
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 50))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 8))
+BATCH_MAX_QUESTIONS = int(os.environ.get("BATCH_MAX_QUESTIONS", 5000))
+METADATA_MIRROR = os.environ.get("METADATA_MIRROR", "0").lower() in ("1", "true", "yes")
+METADATA_MIRROR_PATH = os.environ.get("METADATA_MIRROR_PATH", "metadata_mirror.json")
+METADATA_MIRROR_SYNC_INTERVAL = float(os.environ.get("METADATA_MIRROR_SYNC_INTERVAL", 86400))
+CUBE_SELECTION_MODE = os.environ.get("CUBE_SELECTION_MODE", "function")
+CUBE_ROUTER_MARGIN = float(os.environ.get("CUBE_ROUTER_MARGIN", 0.5))
+CUBE_ROUTER_MIN_SCORE = float(os.environ.get("CUBE_ROUTER_MIN_SCORE", 3.0))
+MULTI_CUBE_MAX = int(os.environ.get("MULTI_CUBE_MAX", 3))
+QUERY_REPAIR_ATTEMPTS = int(os.environ.get("QUERY_REPAIR_ATTEMPTS", 2))
+RESULT_PAGE_SIZE = int(os.environ.get("RESULT_PAGE_SIZE", 1000))
+RESULT_MAX_ROWS = int(os.environ.get("RESULT_MAX_ROWS", 10000))
+RESULT_TIMEOUT = float(os.environ.get("RESULT_TIMEOUT", 60))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 3600))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 handler = LoggingHandler(logger)
 
-# Simple LRU cache with a maximum size
-class LRUCache:
-    def __init__(self, max_size: int):
-        self.cache = OrderedDict()
-        self.max_size = max_size
-
-    def get(self, key: str):
-        if key in self.cache:
-            self.cache.move_to_end(key)
-            return self.cache[key]
-        return None
-
-    def set(self, key: str, value: str):
-        self.cache[key] = value
-        self.cache.move_to_end(key)
-        if len(self.cache) > self.max_size:
-            self.cache.popitem(last=False)
-
-cache = LRUCache(max_size=20)
+# sqlite backend is shared by all uvicorn workers using the same file
+if QUESTION_CACHE_BACKEND == "sqlite":
+    question_cache_backend = SqliteCache(QUESTION_CACHE_PATH, max_bytes=QUESTION_CACHE_MAX_BYTES, ttl=QUESTION_CACHE_TTL)
+else:
+    question_cache_backend = TTLCache(max_bytes=QUESTION_CACHE_MAX_BYTES, ttl=QUESTION_CACHE_TTL)
+cache = QuestionCache(question_cache_backend, similarity_threshold=QUESTION_CACHE_SIMILARITY)
+flights = SingleFlight()
+
+# Paths whose LLM calls wait behind interactive requests
+BATCH_PATHS = {"/batch"}
+scheduler = LLMScheduler(
+    requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+    tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+    max_queue=LLM_QUEUE_MAX,
+    max_wait=LLM_QUEUE_TIMEOUT,
+)
+llm_latencies = LatencyTracker()
+# After repeated failures of the primary model, calls go straight to the fallback model
+llm_breaker = CircuitBreaker("llm", failure_threshold=CIRCUIT_BREAKER_FAILURES, reset_timeout=CIRCUIT_BREAKER_RESET)
+sparql_breaker = CircuitBreaker("sparql", failure_threshold=CIRCUIT_BREAKER_FAILURES, reset_timeout=CIRCUIT_BREAKER_RESET)
+# Rendered prompts and model settings are cached for all chains, across restarts and workers
+llm_cache = LLMResponseCache(
+    SqliteCache(LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES, ttl=LLM_CACHE_TTL),
+    memory=TTLCache(max_bytes=LLM_CACHE_MEMORY_BYTES, ttl=LLM_CACHE_TTL),
+) if LLM_CACHE_PATH else None
+langchain.llm_cache = llm_cache
+chains = ChainRegistry(api_key=OPENAI_API_KEY, handler=handler, max_connections=OPENAI_MAX_CONNECTIONS)
+
+cube_selection_settings = {
+    "temperature": 0.2,
+    "top_p": 0.1,
+}
+if CUBE_SELECTION_MODE == "function":
+    cube_selection_factory = create_cube_selection_function_chain
+else:
+    cube_selection_factory = create_cube_selection_chain
+    cube_selection_settings["streaming"] = CUBE_PREFETCH_COUNT > 0
+
+query_generation_settings = {
+    "temperature": 0.2,
+    "top_p": 0.1,
+}
+catalog = CatalogService(refresh_interval=CATALOG_REFRESH_INTERVAL)
+mirror = MetadataMirror(path=METADATA_MIRROR_PATH or None, sync_interval=METADATA_MIRROR_SYNC_INTERVAL) if METADATA_MIRROR else None
+metadata = CubeMetadataCache(TTLCache(
+    max_bytes=METADATA_CACHE_MAX_BYTES,
+    ttl=METADATA_CACHE_TTL,
+    persist_path=METADATA_CACHE_PATH,
+    keep_expired=True,
+), mirror=mirror, save_interval=METADATA_CACHE_SAVE_INTERVAL)
+# Indexes, term sets and compacted text derived from cube metadata, parsed once per document
+metadata_documents = DocumentCache(max_bytes=DIMENSION_INDEX_MAX_BYTES)
+dimension_indexes = DimensionIndexCache(metadata_documents, ttl=METADATA_CACHE_TTL)
+executor = QueryExecutor(
+    TTLCache(max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL),
+    page_size=RESULT_PAGE_SIZE,
+    max_rows=RESULT_MAX_ROWS,
+    timeout=RESULT_TIMEOUT,
+)
 
 class CubeBody(BaseModel):
     question: str
@@ -46,98 +181,527 @@ class GenerateBody(CubeBody):
     cube: str
 
 class FullBody(CubeBody):
-    pass
-
-app = FastAPI()
+    execute: bool = False
+    cubes: int = 1
+
+class JobBody(CubeBody):
+    cubes: int = 1
+
+class ExecuteBody(BaseModel):
+    query: str
+
+class BatchBody(BaseModel):
+    questions: List[str]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sparql_client = SparqlClient(
+        endpoint=SPARQL_ENDPOINT,
+        max_connections=SPARQL_MAX_CONNECTIONS,
+        max_concurrency=SPARQL_MAX_CONCURRENCY,
+        timeout=SPARQL_TIMEOUT,
+        breaker=sparql_breaker,
+    )
+    set_client(sparql_client)
+    # Executed queries are written by users and the LLM; when they are slow or fail, that says
+    # nothing about the endpoint, so they get their own connections and no circuit breaker
+    executor.client = SparqlClient(
+        endpoint=SPARQL_ENDPOINT,
+        max_connections=SPARQL_MAX_CONNECTIONS,
+        max_concurrency=SPARQL_MAX_CONCURRENCY,
+        timeout=RESULT_TIMEOUT,
+    )
+    setup_opentelemetry()
+    if llm_cache is not None and LLM_CACHE_WARM_UP:
+        loaded = await asyncio.to_thread(llm_cache.warm_up)
+        logger.info(f"Loaded {loaded} cached LLM responses into memory")
+    await chains.start()
+    await jobs.start()
+    chains.get(cube_selection_factory, **cube_selection_settings)
+    chains.get(create_cube_explanation_chain, **query_generation_settings)
+    for streaming in (False, True):
+        chains.get(create_query_generation_chain, streaming=streaming, **query_generation_settings)
+    chains.get(create_query_repair_chain, **query_generation_settings)
+    if LLM_FALLBACK_MODEL:
+        chains.get(cube_selection_factory, model_name=LLM_FALLBACK_MODEL, **cube_selection_settings)
+        chains.get(create_query_generation_chain, model_name=LLM_FALLBACK_MODEL, **query_generation_settings)
+    if mirror is not None:
+        await mirror.start()
+    await metadata.start()
+    await catalog.start()
+    # Serve the mirrored catalog when the endpoint is not reachable at startup
+    if catalog.snapshot is None and mirror is not None and mirror.catalog():
+        await catalog.load(mirror.catalog())
+    yield
+    if mirror is not None:
+        await mirror.stop()
+    await catalog.stop()
+    await metadata.stop()
+    await jobs.stop()
+    await scheduler.close()
+    await chains.close()
+    await sparql_client.close()
+    await executor.client.close()
+    # Commit cache writes still waiting for the SQLite writer threads
+    for backend in (question_cache_backend, llm_cache.backend if llm_cache is not None else None):
+        if isinstance(backend, SqliteCache):
+            await asyncio.to_thread(backend.close)
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    chains.bind_session()
+    set_priority(Priority.BATCH if request.url.path in BATCH_PATHS else Priority.INTERACTIVE)
+    set_deadline(_request_timeout(request))
+    with start_trace(request.headers.get("X-Request-ID")) as trace:
+        started = time.perf_counter()
+        response = await call_next(request)
+        duration = time.perf_counter() - started
+    # Label by route template so the number of series stays bounded
+    route = request.scope.get("route")
+    path = getattr(route, "path", "unmatched")
+    REQUEST_SECONDS.observe(duration, method=request.method, path=path, status=response.status_code)
+    response.headers["X-Request-ID"] = trace.request_id
+    body = response.body_iterator
+
+    # Streamed endpoints run their stages while the body is sent, so the trace is logged after it
+    async def log_after_body() -> AsyncIterator:
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            if trace.spans:
+                total = time.perf_counter() - started
+                log_trace(trace, method=request.method, path=path, status=response.status_code, duration_ms=round(1000 * total, 1))
+
+    response.body_iterator = log_after_body()
+    return response
+
+@app.exception_handler(CircuitOpen)
+async def circuit_open(request: Request, exc: CircuitOpen):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": str(math.ceil(exc.retry_after))})
+
+@app.exception_handler(asyncio.TimeoutError)
+async def timed_out(request: Request, exc: asyncio.TimeoutError):
+    return JSONResponse(status_code=504, content={"detail": "Request timed out"})
+
+def _request_timeout(request: Request) -> Optional[float]:
+    """Seconds the client waits for this request, from X-Request-Timeout or REQUEST_TIMEOUT."""
+    try:
+        return float(request.headers["X-Request-Timeout"])
+    except (KeyError, ValueError):
+        # Batches run for as long as they need unless the client sets a timeout
+        return None if request.url.path in BATCH_PATHS else REQUEST_TIMEOUT
+
 def get_cache_key(question: str, cube: str = None) -> str:
+    question = cache.canonical(question)
+    # Catalog version is part of the key, so answers are not reused across catalog changes
     key = question if cube is None else f"{question}-{cube}"
-    return md5(key.encode()).hexdigest()
+    return md5(f"{catalog.version}-{key}".encode()).hexdigest()
 
-async def _select_cube(question: str) -> str:
-    cube_selection_settings = {
-        "temperature": 0.2,
-        "top_p": 0.1
-    }
-    cubes = fetch_cubes_descriptions()
-    cube_selection_chain = create_cube_selection_chain(api_key=OPENAI_API_KEY, handler=handler, **cube_selection_settings)
-
-    cube_selection_response = await cube_selection_chain.ainvoke({
-        "cubes": cubes,
-        "question": question,
-    })
+async def _admit(chain: LLMChain, inputs: dict) -> None:
+    """Wait for LLM budget, answering 429 when the wait would be too long."""
+    try:
+        with span("llm_queue"):
+            await scheduler.acquire(estimate_tokens(chain, inputs))
+    except Overloaded as e:
+        raise HTTPException(status_code=429, detail="Too many requests, try again later", headers={"Retry-After": str(math.ceil(e.retry_after))})
+
+async def _call_chain(stage: str, chain: LLMChain, inputs: dict, invoke: Callable[[LLMChain], Awaitable[Any]], hedge: bool, llm_kwargs: dict, attributes: dict) -> Any:
+    # Answers from the LLM cache cost no provider budget, so they are not queued or refused
+    if llm_cache is None or not llm_cache.contains(chain, inputs, **llm_kwargs):
+        await _admit(chain, inputs)
+    delay = llm_latencies.percentile(stage, LLM_HEDGE_PERCENTILE) if hedge else None
+    with span(stage, **attributes) as current:
+        record_prompt_prefix(prefix_hash(chain.prompt, inputs))
+        started = time.perf_counter()
+        result = await asyncio.wait_for(
+            hedged(lambda: invoke(chain), delay, lambda: scheduler.try_acquire(estimate_tokens(chain, inputs)), stage),
+            stage_timeout(LLM_TIMEOUT),
+        )
+        # Answers from the LLM cache would make every real call look slow
+        if current.attributes.get("cache") != "hit":
+            llm_latencies.observe(stage, time.perf_counter() - started)
+    return result
+
+async def _call_llm(stage: str, factory: Callable[..., LLMChain], settings: dict, inputs: dict, invoke: Callable[[LLMChain], Awaitable[Any]], hedge: bool = True, llm_kwargs: Optional[dict] = None, **attributes) -> Any:
+    """Call the LLM within the request deadline, hedging slow calls and retrying failed ones on the fallback model.
+
+    llm_kwargs are the arguments invoke binds to the model, needed to recognize LLM cache hits.
+    """
+    fallback = chains.get(factory, model_name=LLM_FALLBACK_MODEL, **settings) if LLM_FALLBACK_MODEL else None
+    if fallback is None or llm_breaker.allow():
+        try:
+            result = await _call_chain(stage, chains.get(factory, **settings), inputs, invoke, hedge, llm_kwargs or {}, attributes)
+        except HTTPException:
+            raise
+        except Exception as e:
+            llm_breaker.failure()
+            if fallback is None or stage_timeout(None) == 0:
+                raise
+            logger.warning(f"{stage} failed, retrying with {LLM_FALLBACK_MODEL}: {e!r}")
+        else:
+            llm_breaker.success()
+            return result
+    LLM_FALLBACKS.inc(stage=stage)
+    return await _call_chain(stage, fallback, inputs, invoke, hedge, llm_kwargs or {}, {**attributes, "model": LLM_FALLBACK_MODEL})
+
+async def _candidate_cubes(question: str) -> Tuple[dict, List[str]]:
+    """Cube selection prompt inputs describing the cubes offered to the LLM, and their IRIs."""
+    with span("catalog") as current:
+        index = await catalog.get_index()
+        candidates = index.candidates(question, k=CUBE_CANDIDATES) if CUBE_CANDIDATES > 0 else []
+        # Questions in other languages or with synonyms match few cubes by keywords, they get the whole catalog
+        if len(candidates) < min(CUBE_CANDIDATES, len(index.cubes)) or CUBE_CANDIDATES <= 0:
+            current.attributes["candidates"] = "catalog"
+            cubes = await asyncio.to_thread(_compact_catalog, index)
+            return cube_selection_inputs(question, cubes, ranked=False), [cube.iri for cube in index.cubes]
+        current.attributes["candidates"] = len(candidates)
+        cubes = compact_cubes(candidates, PROMPT_CATALOG_TOKENS)
+        return cube_selection_inputs(question, cubes, ranked=True), [cube.iri for cube in candidates]
+
+@lru_cache(maxsize=1)
+def _compact_catalog(index: CubeIndex) -> str:
+    # Rendered once per catalog version, a new index is built when the catalog changes
+    return compact_cubes(index.cubes, PROMPT_CATALOG_TOKENS)
+
+async def _route_cube(question: str) -> Optional[str]:
+    if CUBE_ROUTER_MARGIN >= 1:
+        return None
+    index = await catalog.get_index()
+    with span("cube_routing"):
+        cube = index.route(question, min_score=CUBE_ROUTER_MIN_SCORE, min_margin=CUBE_ROUTER_MARGIN)
+    CUBE_ROUTES.inc(route="local" if cube is not None else "llm")
+    return cube.iri if cube is not None else None
+
+async def _select_cubes(question: str, route: bool = True) -> List[str]:
+    # Questions that clearly match one cube by keywords do not need the LLM
+    routed = await _route_cube(question) if route else None
+    if routed is not None:
+        logger.info(f"Routed to {routed} without LLM")
+        return [routed]
+
+    inputs, cube_iris = await _candidate_cubes(question)
+    if CUBE_SELECTION_MODE == "function":
+        return await _select_cubes_with_function(question, inputs, cube_iris)
+
+    # Metadata of cubes mentioned in the streamed response is fetched while the LLM is still answering
+    callbacks = [CubePrefetchHandler(metadata.prefetch, max_cubes=CUBE_PREFETCH_COUNT)] if CUBE_PREFETCH_COUNT > 0 else []
+    cube_selection_response = await _call_llm(
+        "cube_selection", create_cube_selection_chain, cube_selection_settings, inputs,
+        lambda chain: chain.ainvoke(inputs, config={"callbacks": callbacks}),
+        hedge=not callbacks,
+    )
     cube_selection_response = cube_selection_response['text']
 
     logger.info("========== CUBES RESPONSE ================")
     logger.info(f"{cube_selection_response}")
 
-    selected_cubes = parse_all_cubes(cube_selection_response)
+    with span("parse_cubes"):
+        selected_cubes = parse_all_cubes(cube_selection_response)
 
     if not selected_cubes:
-        logger.warning("Failed at parsing cube id from response. Returning 404 and response as a result")
-        raise HTTPException(status_code=404, detail=cube_selection_response)
+        logger.warning("Failed at parsing cube id from response. Returning 404")
+        raise HTTPException(status_code=404, detail="Unable to select proper cube")
+
+    # Cubes in the order the LLM mentions them, best match first
+    return list(dict.fromkeys(selected_cubes))
+
+async def _select_cubes_with_function(question: str, inputs: dict, cube_iris: List[str]) -> List[str]:
+    index = await catalog.get_index()
+    # The function call answer is not streamed, so the best keyword matches are prefetched while the LLM selects
+    for cube, _ in index.search(question, k=CUBE_PREFETCH_COUNT) if CUBE_PREFETCH_COUNT > 0 else []:
+        metadata.prefetch(cube.iri)
+    selected = await _call_llm(
+        "cube_selection", create_cube_selection_function_chain, cube_selection_settings, inputs,
+        lambda chain: select_cubes_with_function(
+            chain,
+            inputs,
+            cube_iris=cube_iris,
+            known_cubes=index.by_iri,
+            max_cubes=max(MULTI_CUBE_MAX, 1),
+        ),
+        llm_kwargs=cube_selection_llm_kwargs(cube_iris, max(MULTI_CUBE_MAX, 1)),
+    )
 
-    return selected_cubes[0]
+    logger.info("========== CUBES RESPONSE ================")
+    logger.info(f"{selected}")
 
-async def _select_cube_cached(question: str) -> str:
-    key = get_cache_key(question)
-    cached = cache.get(key)
-    if cached:
-        return cached
-    cube = await _select_cube(question)
-    cache.set(key, cube)
-    return cube
+    if not selected:
+        logger.warning("No known cube selected. Returning 404")
+        raise HTTPException(status_code=404, detail="Unable to select proper cube")
 
+    return [cube for cube, _ in selected]
 
-async def _generate_query(question: str, cube: str) -> str:
-    cube_and_sample = fetch_cube_sample(cube)
-    dimensions_triplets = fetch_dimensions_triplets(cube)
+async def _select_cubes_cached(question: str, count: int = 1) -> List[str]:
+    # Local routing names one cube, so requests for several cubes ask the LLM and are cached apart
+    route = count <= 1
+    key = get_cache_key(question) if route else get_cache_key(question, "alternatives")
+    cached = cache.get(key)
+    record_cache("questions", bool(cached))
+    if cached:
+        return cached.split("\n")
 
-    query_generation_settings = {
-        "temperature": 0.2,
-        "top_p": 0.1
-    }
+    async def select() -> List[str]:
+        cubes = await _select_cubes(question, route=route)
+        cache.set(key, "\n".join(cubes), question=question)
+        return cubes
 
-    generation_chain = create_query_generation_chain(api_key=OPENAI_API_KEY, handler=handler, **query_generation_settings)
+    # Identical questions in flight at the same time share one LLM call
+    return await flights.do(key, select)
 
-    query_generation_response = await generation_chain.ainvoke({
-        "cube_and_sample": cube_and_sample,
-        "dimensions_triplets": dimensions_triplets,
+async def _select_cube_cached(question: str) -> str:
+    return (await _select_cubes_cached(question))[0]
+
+
+async def _dimensions_for_prompt(dimensions_n3: str, question: str) -> str:
+    # Parsing and indexing large code lists takes long, it runs in a thread so other requests go on
+    if DIMENSION_VALUES_MAX <= 0:
+        return await asyncio.to_thread(dimension_indexes.labels, dimensions_n3, PROMPT_DIMENSIONS_TOKENS)
+    with span("dimension_values"):
+        return await asyncio.to_thread(
+            dimension_indexes.relevant, dimensions_n3, question, PROMPT_DIMENSIONS_TOKENS,
+            max_values=DIMENSION_VALUES_MAX, full_values=DIMENSION_VALUES_FULL,
+        )
+
+def _compact_sample(sample_n3: str) -> str:
+    return compact_n3(sample_n3, PROMPT_SAMPLE_TOKENS)
+
+async def _generate_query(question: str, cube: str, callbacks: Optional[List] = None) -> str:
+    sample_n3, dimensions_n3 = await metadata.fetch(cube)
+    inputs = {
+        "cube_and_sample": await asyncio.to_thread(metadata_documents.get, "sample", sample_n3, _compact_sample),
+        "dimensions_triplets": await _dimensions_for_prompt(dimensions_n3, question),
         "cube": cube,
         "question": question,
-    })
+    }
+
+    # Streamed tokens cannot be taken back, so streamed calls are not hedged
+    query_generation_response = await _call_llm(
+        "query_generation", create_query_generation_chain, {"streaming": bool(callbacks), **query_generation_settings}, inputs,
+        lambda chain: chain.ainvoke(inputs, config={"callbacks": callbacks or []}),
+        hedge=not callbacks,
+        cube=cube,
+    )
     query_generation_response = query_generation_response['text']
 
     logger.info("========== QUERY GENERATION RESPONSE ================")
     logger.info(f"{query_generation_response}")
 
-    return query_generation_response
+    return await _validate_query(query_generation_response, inputs, sample_n3, dimensions_n3)
+
+async def _validate_query(response: str, inputs: dict, sample_n3: str, dimensions_n3: str) -> str:
+    """Check the generated query locally and let the LLM fix reported problems, instead of regenerating it."""
+    query = clean_query(response)
+    for attempt in range(QUERY_REPAIR_ATTEMPTS + 1):
+        with span("query_validation"):
+            errors = await asyncio.to_thread(validate_query, query, sample_n3, dimensions_n3, documents=metadata_documents)
+        if not errors:
+            QUERY_VALIDATIONS.inc(result="valid" if attempt == 0 else "repaired")
+            return query
+        logger.info(f"Generated query failed validation: {errors}")
+        if attempt == QUERY_REPAIR_ATTEMPTS:
+            break
+        repair_inputs = {
+            **inputs,
+            "query": query,
+            "errors": "\n".join(f"- {error}" for error in errors),
+        }
+        repair_response = await _call_llm(
+            "query_repair", create_query_repair_chain, query_generation_settings, repair_inputs,
+            lambda chain: chain.ainvoke(repair_inputs),
+            attempt=attempt + 1,
+        )
+        query = clean_query(repair_response['text'])
+
+    QUERY_VALIDATIONS.inc(result="invalid")
+    logger.warning("Returning query that failed validation")
+    return query
 
 async def _generate_query_cached(question: str, cube: str) -> str:
     key = get_cache_key(question, cube)
     cached = cache.get(key)
+    record_cache("questions", bool(cached))
     if cached:
         return cached
-    query = await _generate_query(question, cube)
-    cache.set(key, query)
-    return query
+
+    async def generate() -> str:
+        query = await _generate_query(question, cube)
+        cache.set(key, query, question=question)
+        return query
+
+    return await flights.do(key, generate)
 
 
 @app.post("/cube")
 async def select_cube(body: CubeBody):
     logger.info(f"Select cube request: {body}")
     return {
-        "result": await _select_cube(body.question)
+        "result": await _select_cube_cached(body.question)
     }
 
 
+@app.post("/explain")
+async def explain_cube(body: GenerateBody):
+    """Why a cube answers a question, only computed when asked for (e.g. by the UI)."""
+    logger.info(f"Explain request: {body}")
+    index = await catalog.get_index()
+    cube = index.by_iri.get(body.cube)
+    if cube is None:
+        raise HTTPException(status_code=404, detail="Unknown cube")
+
+    key = get_cache_key(body.question, f"{body.cube}-explanation")
+    cached = cache.get(key)
+    record_cache("questions", bool(cached))
+    if cached:
+        return {"result": cached}
+
+    async def explain() -> str:
+        inputs = {
+            "cube_description": f"{cube.iri}\n{cube.label}\n{cube.description}",
+            "question": body.question,
+        }
+        response = await _call_llm(
+            "cube_explanation", create_cube_explanation_chain, query_generation_settings, inputs,
+            lambda chain: chain.ainvoke(inputs),
+        )
+        cache.set(key, response['text'], question=body.question)
+        return response['text']
+
+    return {"result": await flights.do(key, explain)}
+
+
 @app.post("/query")
 async def select_cube(body: GenerateBody):
     logger.info(f"Generate query request: {body}")
     return {
-        "result": await _generate_query(body.question, body.cube)
+        "result": await _generate_query_cached(body.question, body.cube)
+    }
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _stream_pipeline(question: str) -> AsyncIterator[str]:
+    try:
+        cube = await _select_cube_cached(question)
+        yield _sse("cube", {"cube": cube})
+
+        key = get_cache_key(question, cube)
+        query = cache.get(key)
+        if query is None:
+            await metadata.fetch(cube)
+            yield _sse("metadata", {"cube": cube})
+
+            tokens = asyncio.Queue()
+
+            async def generate() -> str:
+                try:
+                    return await _generate_query(question, cube, callbacks=[TokenQueueHandler(tokens)])
+                finally:
+                    tokens.put_nowait(None)
+
+            generation = asyncio.create_task(generate())
+            while (token := await tokens.get()) is not None:
+                yield _sse("token", {"token": token})
+            query = await generation
+            cache.set(key, query, question=question)
+
+        yield _sse("query", {"cube": cube, "query": query})
+    except HTTPException as e:
+        yield _sse("error", {"detail": e.detail})
+    except Exception:
+        logger.exception("Streaming pipeline failed")
+        yield _sse("error", {"detail": "Query generation failed"})
+
+
+@app.post("/stream")
+async def stream_cube_and_query(body: FullBody):
+    logger.info(f"Streaming generate request: {body}")
+    return StreamingResponse(
+        _stream_pipeline(body.question),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _stream_batch(questions: List[str]) -> AsyncIterator[str]:
+    results = run_question_batch(
+        questions,
+        select_cube=_select_cube_cached,
+        fetch_metadata=metadata.fetch,
+        generate_query=_generate_query_cached,
+        concurrency=BATCH_CONCURRENCY,
+    )
+    async for result in results:
+        yield json.dumps(result) + "\n"
+
+
+@app.post("/batch")
+async def batch_generate_queries(body: BatchBody):
+    logger.info(f"Batch generate request: {len(body.questions)} questions")
+    if len(body.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_QUESTIONS} questions per batch")
+    return StreamingResponse(_stream_batch(body.questions), media_type="application/x-ndjson")
+
+
+async def _execution_response(query: str, first: Optional[dict] = None) -> StreamingResponse:
+    results = executor.execute(query)
+    # Errors before the first message (invalid query, endpoint rejecting it) are still reported with a status code
+    try:
+        head = await results.__anext__()
+    except QueryNotExecutable as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except aiohttp.ClientResponseError as e:
+        raise HTTPException(status_code=502, detail=f"SPARQL endpoint returned {e.status}: {e.message}")
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="SPARQL endpoint timed out")
+
+    async def lines() -> AsyncIterator[str]:
+        if first is not None:
+            yield json.dumps(first) + "\n"
+        yield json.dumps(head) + "\n"
+        try:
+            async for message in results:
+                yield json.dumps(message) + "\n"
+        except Exception:
+            logger.exception("Query execution failed")
+            yield json.dumps({"error": "Query execution failed"}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/execute")
+async def execute_query(body: ExecuteBody):
+    logger.info(f"Execute request: {body}")
+    return await _execution_response(body.query)
+
+
+async def _generate_alternative(question: str, cube: str) -> dict:
+    try:
+        return {"cube": cube, "query": await _generate_query_cached(question, cube)}
+    except Exception as e:
+        logger.exception(f"Query generation for {cube} failed")
+        return {"cube": cube, "error": error_detail(e)}
+
+async def _generate_alternatives(body: FullBody):
+    count = min(body.cubes, MULTI_CUBE_MAX)
+    cubes = (await _select_cubes_cached(body.question, count))[:count]
+    # Metadata fetch and generation run for all cubes at once, so this takes about as long as one cube
+    alternatives = await asyncio.gather(*(_generate_alternative(body.question, cube) for cube in cubes))
+    generated = [alternative for alternative in alternatives if "query" in alternative]
+    if not generated:
+        raise HTTPException(status_code=502, detail=alternatives)
+    if body.execute:
+        first = {"cube": generated[0]["cube"], "result": generated[0]["query"], "alternatives": alternatives}
+        return await _execution_response(generated[0]["query"], first=first)
+    return {
+        "result": generated[0]["query"],
+        "alternatives": alternatives,
     }
 
 
@@ -145,14 +709,60 @@ async def select_cube(body: GenerateBody):
 async def select_cube_and_generate_query(body: FullBody):
     logger.info(f"Full generate request: {body}")
 
-    selected_cube = await _select_cube(body.question)
+    if body.cubes > 1:
+        return await _generate_alternatives(body)
 
-    query = await _generate_query(body.question, selected_cube)
+    selected_cube = await _select_cube_cached(body.question)
+
+    query = await _generate_query_cached(body.question, selected_cube)
+    if body.execute:
+        return await _execution_response(query, first={"cube": selected_cube, "result": query})
     return {
         "result": query
     }
 
-    # NOTE: currently only query is returned. Returning query result is possible.
+async def _run_job(request: dict) -> dict:
+    body = JobBody(**request)
+    while True:
+        try:
+            if body.cubes > 1:
+                return await _generate_alternatives(FullBody(question=body.question, cubes=body.cubes))
+            cube = await _select_cube_cached(body.question)
+            return {"cube": cube, "result": await _generate_query_cached(body.question, cube)}
+        except HTTPException as e:
+            # Nobody is waiting on the response, so a job waits for LLM budget instead of failing
+            if e.status_code != 429:
+                raise
+            logger.info(f"LLM budget exhausted, job retries in {e.headers['Retry-After']}s")
+            await asyncio.sleep(float(e.headers["Retry-After"]))
+
+def _start_job_worker() -> None:
+    chains.bind_session()
+    # Background jobs wait behind interactive requests for LLM budget
+    set_priority(Priority.BATCH)
+
+# Job records share the question cache, its backend and TTL
+jobs = JobQueue(cache, _run_job, workers=JOB_WORKERS, max_queue=JOB_QUEUE_MAX, on_start=_start_job_worker)
+
+@app.post("/jobs", status_code=202)
+async def submit_job(body: JobBody):
+    """Run the question pipeline in the background, the result is polled from GET /jobs/{id}."""
+    logger.info(f"Job request: {body}")
+    cubes = max(1, min(body.cubes, MULTI_CUBE_MAX))
+    # Same question, same job: a finished job is answered right away
+    job_id = get_cache_key(body.question, f"job-{cubes}")
+    try:
+        return jobs.submit(job_id, {"question": body.question, "cubes": cubes})
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=429, detail="Too many queued jobs, try again later", headers={"Retry-After": "10"})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    """Job status and result; with wait, respond as soon as the job finishes, after at most that many seconds."""
+    job = await jobs.wait(job_id, min(wait, JOB_MAX_WAIT)) if wait > 0 else jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
 
 @app.get("/")
 def get_status():
@@ -160,6 +770,30 @@ def get_status():
         "status": "Service is up and running"
     }
 
+@app.get("/catalog")
+def get_catalog_status():
+    return catalog.status()
+
+@app.get("/mirror")
+def get_mirror_status():
+    if mirror is None:
+        return {"enabled": False}
+    return {"enabled": True, **mirror.status()}
+
+@app.get("/cache")
+def get_cache_status():
+    return {
+        "metadata": metadata.stats(),
+        "metadata_documents": metadata_documents.stats(),
+        "questions": cache.stats(),
+        "results": executor.cache.stats(),
+        "llm": llm_cache.stats() if llm_cache is not None else None,
+    }
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/favicon.ico", include_in_schema=False)
 async def favicon():
     return FileResponse("app/static/favicon.ico")
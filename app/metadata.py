@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, Set, Tuple
+
+from app.cache import TTLCache
+from app.lib import fetch_cube_sample, fetch_dimensions_triplets
+from app.metrics import record_cache, span
+from app.mirror import MetadataMirror
+from app.resilience import detached_task
+from app.singleflight import SingleFlight
+from app.sparql import SparqlClient
+
+logger = logging.getLogger(__name__)
+
+
+class CubeMetadataCache:
+    """Per-cube sample observation and dimension labels, cached by cube IRI
+
+    Cubes present in the local mirror (if any) are answered from it without a query.
+    A persisted cache is saved every save_interval seconds and on stop.
+    """
+
+    def __init__(self, cache: TTLCache, client: Optional[SparqlClient] = None, mirror: Optional[MetadataMirror] = None, save_interval: float = 60.0) -> None:
+        self.cache = cache
+        self.client = client
+        self.mirror = mirror
+        self.save_interval = save_interval
+        self._flights = SingleFlight()
+        self._prefetching: Set[asyncio.Task] = set()
+        self._save_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self.cache.persist_path:
+            self._save_task = asyncio.create_task(self._save_loop())
+
+    async def stop(self) -> None:
+        if self._save_task is not None:
+            self._save_task.cancel()
+        await self.cache.save_async()
+
+    async def _save_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.save_interval)
+            await self.cache.save_async()
+
+    async def sample(self, cube: str) -> str:
+        with span("sample_fetch", cube=cube):
+            return await self._get(f"sample:{cube}", lambda: fetch_cube_sample(cube, client=self.client))
+
+    async def dimensions(self, cube: str) -> str:
+        with span("dimensions_fetch", cube=cube):
+            return await self._get(f"dimensions:{cube}", lambda: fetch_dimensions_triplets(cube, client=self.client))
+
+    async def fetch(self, cube: str) -> Tuple[str, str]:
+        """Fetch sample and dimension labels of a cube concurrently."""
+        sample, dimensions = await asyncio.gather(self.sample(cube), self.dimensions(cube))
+        return sample, dimensions
+
+    def prefetch(self, cube: str) -> None:
+        """Start loading metadata of a cube in the background."""
+        logger.info(f"Prefetching metadata for {cube}")
+        task = detached_task(self.fetch(cube))
+        self._prefetching.add(task)
+        task.add_done_callback(self._prefetching.discard)
+        task.add_done_callback(_log_prefetch_error)
+
+    async def _get(self, key: str, fetch: Callable[[], Awaitable[str]]) -> str:
+        mirrored = self.mirror.get(key) if self.mirror is not None else None
+        if mirrored is not None:
+            record_cache("mirror", True)
+            return mirrored
+        cached = self.cache.get(key)
+        record_cache("metadata", cached is not None)
+        if cached is not None:
+            return cached
+        # Requests for a cube that is already being fetched (e.g. prefetched) await the same query
+        return await self._flights.do(key, lambda: self._load(key, fetch))
+
+    async def _load(self, key: str, fetch: Callable[[], Awaitable[str]]) -> str:
+        try:
+            value = await fetch()
+        except Exception as e:
+            # Cube metadata rarely changes, an expired copy beats failing while the endpoint is down
+            stale = self.cache.get(key, allow_expired=True)
+            if stale is None:
+                raise
+            logger.warning(f"Serving stale {key}: {e!r}")
+            record_cache("metadata_stale", True)
+            return stale
+        self.cache.set(key, value)
+        return value
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
+def _log_prefetch_error(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Metadata prefetch failed: {task.exception()!r}")
@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import time
+import uuid
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = defaultdict(float)
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        self.values[tuple(str(labels[name]) for name in self.labels)] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels: str) -> None:
+        self.values[tuple(str(labels[name]) for name in self.labels)] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.counts: Dict[Tuple[str, ...], List[int]] = {}
+        self.sums: Dict[Tuple[str, ...], float] = defaultdict(float)
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, counts in sorted(self.counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = _format_labels(self.labels, key, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {self.sums[key]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+REGISTRY: List = []
+
+REQUEST_SECONDS = Histogram("llm_playground_request_duration_seconds", "HTTP request duration until response headers", ("method", "path", "status"))
+STAGE_SECONDS = Histogram("llm_playground_stage_duration_seconds", "Duration of pipeline stages", ("stage",))
+SPARQL_SECONDS = Histogram("llm_playground_sparql_request_duration_seconds", "Duration of SPARQL endpoint round trips", ("status",))
+LLM_TOKENS = Counter("llm_playground_llm_tokens_total", "Tokens reported by the LLM provider", ("stage", "type"))
+CACHE_REQUESTS = Counter("llm_playground_cache_requests_total", "Cache lookups", ("cache", "result"))
+CUBE_ROUTES = Counter("llm_playground_cube_routes_total", "Cube selections by the local router or the LLM", ("route",))
+QUERY_VALIDATIONS = Counter("llm_playground_query_validations_total", "Generated queries by validation outcome", ("result",))
+LLM_ADMISSIONS = Counter("llm_playground_llm_admissions_total", "LLM calls admitted, shed or timed out by the scheduler", ("priority", "result"))
+LLM_QUEUE_DEPTH = Gauge("llm_playground_llm_queue_depth", "LLM calls waiting for budget", ("priority",))
+LLM_QUEUE_SECONDS = Histogram("llm_playground_llm_queue_wait_seconds", "Time LLM calls waited for budget", ("priority",))
+HEDGED_REQUESTS = Counter("llm_playground_llm_hedged_requests_total", "Duplicate LLM requests sent after a slow response, and how often they won", ("stage", "result"))
+LLM_FALLBACKS = Counter("llm_playground_llm_fallbacks_total", "LLM calls answered by the fallback model", ("stage",))
+CIRCUIT_OPEN = Gauge("llm_playground_circuit_open", "Whether calls to a dependency are stopped after repeated failures", ("circuit",))
+JOBS = Counter("llm_playground_jobs_total", "Finished background jobs", ("result",))
+JOBS_QUEUED = Gauge("llm_playground_jobs_queued", "Background jobs waiting for a worker")
+PROMPT_PREFIXES = Counter("llm_playground_prompt_prefixes_total", "LLM calls by whether their stable prompt prefix was sent recently", ("stage", "result"))
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+@dataclass
+class Span:
+    stage: str
+    started: float
+    duration: Optional[float] = None
+    attributes: dict = field(default_factory=dict)
+
+
+@dataclass
+class Trace:
+    request_id: str
+    spans: List[Span] = field(default_factory=list)
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_span: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+_tracer = None
+
+# Providers keep cached prefixes for minutes, so a bounded set of recent ones is enough
+RECENT_PREFIXES = 1024
+_recent_prefixes: "OrderedDict[Tuple[str, str], None]" = OrderedDict()
+
+
+def setup_opentelemetry(service_name: str = "llm-playground") -> None:
+    """Export spans to an OTLP collector when OTEL_EXPORTER_OTLP_ENDPOINT is set and OpenTelemetry is installed."""
+    global _tracer
+    if not os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logger.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set but opentelemetry-sdk is not installed")
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer(__name__)
+
+
+@contextmanager
+def start_trace(request_id: Optional[str] = None) -> Iterator[Trace]:
+    trace = Trace(request_id=request_id or uuid.uuid4().hex)
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+@contextmanager
+def span(stage: str, **attributes) -> Iterator[Span]:
+    """Time a pipeline stage, recording it in the current request trace and in STAGE_SECONDS."""
+    current = Span(stage=stage, started=time.time(), attributes=attributes)
+    trace = _trace.get()
+    if trace is not None:
+        trace.spans.append(current)
+    token = _span.set(current)
+    otel_span = _tracer.start_as_current_span(stage) if _tracer is not None else None
+    otel = otel_span.__enter__() if otel_span is not None else None
+    started = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - started
+        STAGE_SECONDS.observe(current.duration, stage=stage)
+        if otel is not None:
+            for key, value in current.attributes.items():
+                otel.set_attribute(key, value)
+            otel_span.__exit__(None, None, None)
+        _span.reset(token)
+
+
+def current_span() -> Optional[Span]:
+    return _span.get()
+
+
+def cached_tokens(token_usage: dict) -> int:
+    """Prompt tokens the provider served from its prompt prefix cache."""
+    return (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+
+def record_tokens(token_usage: dict) -> None:
+    """Add token counts reported by the provider to the current span and LLM_TOKENS."""
+    current = current_span()
+    stage = current.stage if current is not None else "unknown"
+    counts = {
+        "prompt": token_usage.get("prompt_tokens", 0),
+        "completion": token_usage.get("completion_tokens", 0),
+        "cached": cached_tokens(token_usage),
+    }
+    for token_type, count in counts.items():
+        LLM_TOKENS.inc(count, stage=stage, type=token_type)
+        if current is not None:
+            current.attributes[f"{token_type}_tokens"] = current.attributes.get(f"{token_type}_tokens", 0) + count
+
+
+def record_prompt_prefix(prefix: str) -> None:
+    """Count whether the stable prompt prefix of the current stage was sent recently, and could be cached by the provider."""
+    current = current_span()
+    stage = current.stage if current is not None else "unknown"
+    seen = (stage, prefix) in _recent_prefixes
+    _recent_prefixes[(stage, prefix)] = None
+    _recent_prefixes.move_to_end((stage, prefix))
+    while len(_recent_prefixes) > RECENT_PREFIXES:
+        _recent_prefixes.popitem(last=False)
+    PROMPT_PREFIXES.inc(stage=stage, result="repeated" if seen else "new")
+    if current is not None:
+        current.attributes["prompt_prefix"] = prefix
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+    current = current_span()
+    if current is not None:
+        current.attributes["cache"] = "hit" if hit else "miss"
+
+
+def log_trace(trace: Trace, **attributes) -> None:
+    logger.info(json.dumps({
+        "request_id": trace.request_id,
+        **attributes,
+        "spans": [
+            {
+                "stage": current.stage,
+                "start": round(current.started, 3),
+                "duration_ms": round(1000 * current.duration, 1) if current.duration is not None else None,
+                **current.attributes,
+            }
+            for current in trace.spans
+        ],
+    }))
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+from app.lib import (fetch_cube_sample, fetch_cubes_descriptions,
+                     fetch_dimensions_triplets)
+from app.ranking import parse_cubes
+from app.sparql import SparqlClient
+
+logger = logging.getLogger(__name__)
+
+CATALOG_KEY = "catalog"
+
+
+class MetadataMirror:
+    """Local copy of the BAFU cube catalog and of the sample and dimension labels of every cube.
+
+    Entries use the keys of CubeMetadataCache ("sample:<cube>", "dimensions:<cube>"),
+    so lookups are a dict access. The mirror is synced in the background every
+    sync_interval seconds and, when path is given, persisted to a JSON file so it
+    can be served right after a restart even if the endpoint is down.
+    """
+
+    def __init__(self, path: Optional[str] = None, sync_interval: float = 86400.0, concurrency: int = 4, client: Optional[SparqlClient] = None) -> None:
+        self.path = path
+        self.sync_interval = sync_interval
+        self.concurrency = concurrency
+        self.client = client
+        self.entries: Dict[str, str] = {}
+        self.synced_at: Optional[float] = None
+        self.failed_cubes = 0
+        self._sync_lock = asyncio.Lock()
+        self._loop_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self.path:
+            await asyncio.to_thread(self.load)
+        self._loop_task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self) -> None:
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+
+    def get(self, key: str) -> Optional[str]:
+        return self.entries.get(key)
+
+    def catalog(self) -> Optional[str]:
+        return self.entries.get(CATALOG_KEY)
+
+    async def sync(self) -> None:
+        """Fetch catalog and metadata of all cubes, keeping previous entries of cubes that fail."""
+        async with self._sync_lock:
+            started = time.perf_counter()
+            catalog = await fetch_cubes_descriptions(client=self.client)
+            cubes = [cube.iri for cube in await asyncio.to_thread(parse_cubes, catalog)]
+            entries = {CATALOG_KEY: catalog}
+            semaphore = asyncio.Semaphore(self.concurrency)
+            failed = 0
+
+            async def sync_cube(cube: str) -> None:
+                nonlocal failed
+                async with semaphore:
+                    try:
+                        sample, dimensions = await asyncio.gather(
+                            fetch_cube_sample(cube, client=self.client),
+                            fetch_dimensions_triplets(cube, client=self.client),
+                        )
+                    except Exception as e:
+                        failed += 1
+                        logger.warning(f"Mirror sync of {cube} failed: {e!r}")
+                        for key in (f"sample:{cube}", f"dimensions:{cube}"):
+                            if key in self.entries:
+                                entries[key] = self.entries[key]
+                        return
+                entries[f"sample:{cube}"] = sample
+                entries[f"dimensions:{cube}"] = dimensions
+
+            await asyncio.gather(*(sync_cube(cube) for cube in cubes))
+            self.entries = entries
+            self.synced_at = time.time()
+            self.failed_cubes = failed
+            logger.info(f"Mirrored metadata of {len(cubes) - failed}/{len(cubes)} cubes in {time.perf_counter() - started:.1f}s")
+            if self.path:
+                await asyncio.to_thread(self.save)
+
+    async def _sync_loop(self) -> None:
+        # A mirror loaded from disk is only synced once it is older than the interval
+        delay = max(0.0, self.synced_at + self.sync_interval - time.time()) if self.synced_at else 0.0
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("Mirror sync failed, serving previous mirror")
+            delay = self.sync_interval
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as file:
+                stored = json.load(file)
+        except (OSError, ValueError):
+            logger.exception(f"Failed to load mirror from {self.path}")
+            return
+        self.entries = stored["entries"]
+        self.synced_at = stored["synced_at"]
+
+    def save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump({"synced_at": self.synced_at, "entries": self.entries}, file)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logger.exception(f"Failed to persist mirror to {self.path}")
+
+    def status(self) -> dict:
+        return {
+            "cubes": sum(1 for key in self.entries if key.startswith("sample:")),
+            "bytes": sum(len(value) for value in self.entries.values()),
+            "synced_at": self.synced_at,
+            "age_seconds": round(time.time() - self.synced_at, 1) if self.synced_at else None,
+            "failed_cubes": self.failed_cubes,
+            "syncing": self._sync_lock.locked(),
+        }
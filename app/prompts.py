@@ -0,0 +1,33 @@
+from enum import IntEnum
+from hashlib import sha256
+from typing import Tuple
+
+from langchain.prompts.chat import ChatPromptTemplate
+
+
+class PromptLayer(IntEnum):
+    """How often the content of a prompt message changes, from never to every request."""
+
+    STATIC = 0
+    CATALOG = 1
+    CUBE = 2
+    QUESTION = 3
+
+
+def layered_prompt(*messages: Tuple[PromptLayer, str, str]) -> ChatPromptTemplate:
+    """Chat prompt from (layer, role, template) messages, ordered from static to per-question content.
+
+    Providers cache the longest prompt prefix they have seen recently, so keeping
+    stable content first lets requests about the same catalog or cube reuse it.
+    Only the last message may depend on the question.
+    """
+    layers = [layer for layer, _, _ in messages]
+    if layers != sorted(layers) or layers.count(PromptLayer.QUESTION) != 1 or layers[-1] != PromptLayer.QUESTION:
+        raise ValueError(f"Prompt layers must go from static to a single question message, got {layers}")
+    return ChatPromptTemplate.from_messages([(role, template) for _, role, template in messages])
+
+
+def prefix_hash(prompt: ChatPromptTemplate, inputs: dict) -> str:
+    """Hash of everything before the question message, equal for requests that can share a cached prefix."""
+    messages = prompt.format_messages(**inputs)[:-1]
+    return sha256("\n".join(f"{message.type}:{message.content}" for message in messages).encode()).hexdigest()[:16]
@@ -0,0 +1,121 @@
+import math
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from rdflib import RDF, Graph, Literal, Namespace, URIRef
+
+CUBE = Namespace("https://cube.link/")
+SCHEMA = Namespace("http://schema.org/")
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "between", "by", "compared", "data", "for", "from",
+    "get", "give", "had", "has", "have", "how", "in", "is", "it", "list", "me", "of", "on", "or",
+    "show", "the", "there", "this", "to", "was", "were", "what", "when", "where", "which", "who",
+    "with", "year", "years",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [stem(token) for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+
+def stem(token: str) -> str:
+    for suffix in ("ies", "es", "s", "ing", "ed"):
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[: -len(suffix)] + ("y" if suffix == "ies" else "")
+    return token
+
+
+@dataclass
+class CubeInfo:
+    iri: str
+    label: str
+    description: str
+
+
+def parse_cubes(catalog: str) -> List[CubeInfo]:
+    graph = Graph()
+    graph.parse(data=catalog, format="turtle")
+    cubes = []
+    for cube in sorted(graph.subjects(RDF.type, CUBE.Cube)):
+        cubes.append(CubeInfo(
+            iri=f"<{cube}>",
+            label=str(graph.value(cube, SCHEMA.name) or ""),
+            description=str(graph.value(cube, SCHEMA.description) or ""),
+        ))
+    return cubes
+
+
+def cubes_to_graph(cubes: List[CubeInfo]) -> Graph:
+    graph = Graph()
+    graph.bind("cube", CUBE)
+    graph.bind("schema", SCHEMA, override=True, replace=True)
+    for cube in cubes:
+        subject = URIRef(cube.iri.strip("<>"))
+        graph.add((subject, RDF.type, CUBE.Cube))
+        graph.add((subject, SCHEMA.name, Literal(cube.label, lang="en")))
+        graph.add((subject, SCHEMA.description, Literal(cube.description, lang="en")))
+    return graph
+
+
+class CubeIndex:
+    """BM25 index over cube labels and descriptions.
+
+    Works offline and scales to thousands of cubes; labels are weighted twice.
+    """
+
+    def __init__(self, cubes: List[CubeInfo], k1: float = 1.5, b: float = 0.75) -> None:
+        self.cubes = cubes
+        self.by_iri = {cube.iri: cube for cube in cubes}
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.doc_lengths: List[int] = []
+
+        for doc_id, cube in enumerate(cubes):
+            tokens = tokenize(cube.label) * 2 + tokenize(cube.description)
+            self.doc_lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                self.postings[term].append((doc_id, frequency))
+
+        self.average_length = sum(self.doc_lengths) / len(cubes) if cubes else 0.0
+        self.idf = {
+            term: math.log(1 + (len(cubes) - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    @classmethod
+    def from_n3(cls, catalog: str) -> "CubeIndex":
+        return cls(parse_cubes(catalog))
+
+    def search(self, question: str, k: int = 10) -> List[Tuple[CubeInfo, float]]:
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(question)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, frequency in self.postings[term]:
+                norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / self.average_length
+                scores[doc_id] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.cubes[doc_id], score) for doc_id, score in ranked]
+
+    def candidates(self, question: str, k: int = 10) -> List[CubeInfo]:
+        return [cube for cube, _ in self.search(question, k)]
+
+    def route(self, question: str, min_score: float, min_margin: float) -> Optional[CubeInfo]:
+        """Best cube when it clearly beats the runner-up, None when the question is ambiguous.
+
+        The margin is relative: (best - second) / best has to exceed min_margin.
+        """
+        ranked = self.search(question, k=2)
+        if not ranked or ranked[0][1] < min_score:
+            return None
+        best = ranked[0][1]
+        second = ranked[1][1] if len(ranked) > 1 else 0.0
+        if (best - second) / best > min_margin:
+            return ranked[0][0]
+        return None
@@ -0,0 +1,134 @@
+import asyncio
+import contextvars
+import time
+from collections import defaultdict, deque
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Coroutine, Deque, Dict, Optional, TypeVar
+
+from app.metrics import CIRCUIT_OPEN, HEDGED_REQUESTS
+
+T = TypeVar("T")
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+def set_deadline(seconds: Optional[float]) -> None:
+    """Deadline of the current request, seconds from now, None for no deadline."""
+    _deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+def stage_timeout(limit: Optional[float]) -> Optional[float]:
+    """Timeout of a stage: its own limit, shortened to the time left until the request deadline."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return limit
+    left = max(deadline - time.monotonic(), 0.0)
+    return left if limit is None else min(limit, left)
+
+
+def detached_task(coro: Coroutine) -> asyncio.Task:
+    """Task running coro without the deadline of the current request, for work that outlives it or is shared."""
+    context = contextvars.copy_context()
+    context.run(_deadline.set, None)
+    return context.run(asyncio.create_task, coro)
+
+
+class CircuitOpen(Exception):
+    def __init__(self, name: str, retry_after: float) -> None:
+        super().__init__(f"{name} is failing, not calling it for {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calling a failing dependency after failure_threshold consecutive failures.
+
+    While open, allow() is False except for one probe call every reset_timeout
+    seconds; the first success closes the circuit again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now >= self.opened_at + self.reset_timeout:
+            # Let one probe through and keep the others out for another reset_timeout
+            self.opened_at = now
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        return max(self.opened_at + self.reset_timeout - time.monotonic(), 0.0) if self.opened_at is not None else 0.0
+
+    def check(self) -> None:
+        if not self.allow():
+            raise CircuitOpen(self.name, self.retry_after())
+
+    def success(self) -> None:
+        self.failures = 0
+        if self.opened_at is not None:
+            self.opened_at = None
+            CIRCUIT_OPEN.set(0, circuit=self.name)
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            CIRCUIT_OPEN.set(1, circuit=self.name)
+
+
+class LatencyTracker:
+    """Recent latencies per stage, to know when a call is slower than usual."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20) -> None:
+        self.min_samples = min_samples
+        self.latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=window))
+
+    def observe(self, stage: str, seconds: float) -> None:
+        self.latencies[stage].append(seconds)
+
+    def percentile(self, stage: str, percentile: float) -> Optional[float]:
+        """Latency percentile of stage, None until min_samples calls were observed."""
+        latencies = self.latencies[stage]
+        if percentile <= 0 or len(latencies) < self.min_samples:
+            return None
+        return sorted(latencies)[int(percentile * (len(latencies) - 1))]
+
+
+async def hedged(call: Callable[[], Awaitable[T]], delay: Optional[float], may_hedge: Callable[[], bool], stage: str) -> T:
+    """Result of call, started a second time when the first has not answered after delay seconds.
+
+    The first successful answer wins and the other call is cancelled. may_hedge
+    is asked before sending the duplicate, so it can be skipped when over budget.
+    """
+    first = asyncio.ensure_future(call())
+    if delay is None:
+        return await first
+    second: Optional[asyncio.Future] = None
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not may_hedge():
+            return await first
+        HEDGED_REQUESTS.inc(stage=stage, result="sent")
+        second = asyncio.ensure_future(call())
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        HEDGED_REQUESTS.inc(stage=stage, result="won")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in (first, second):
+            if task is not None and not task.done():
+                task.cancel()
@@ -0,0 +1,198 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Dict, List, Optional, Union
+
+from langchain.chains import LLMChain
+
+from app.compact import count_tokens
+from app.metrics import LLM_ADMISSIONS, LLM_QUEUE_DEPTH, LLM_QUEUE_SECONDS
+from app.resilience import stage_timeout
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+class SharedPriority:
+    """Priority of work shared by several callers, the most urgent of their priorities.
+
+    Callers can join while the work is running, so a call made for a batch request
+    is upgraded when an interactive request starts waiting for the same result.
+    """
+
+    def __init__(self) -> None:
+        self.callers: List[Union[Priority, "SharedPriority"]] = []
+
+    def join(self) -> None:
+        """Add the priority of the current caller."""
+        self.callers.append(_priority.get())
+
+    def current(self) -> Priority:
+        return min((_resolve(caller) for caller in self.callers), default=Priority.INTERACTIVE)
+
+
+_priority: ContextVar[Union[Priority, SharedPriority]] = ContextVar("priority", default=Priority.INTERACTIVE)
+
+
+def _resolve(priority: Union[Priority, SharedPriority]) -> Priority:
+    return priority.current() if isinstance(priority, SharedPriority) else priority
+
+
+def set_priority(priority: Union[Priority, SharedPriority]) -> None:
+    """Priority of the LLM calls made in the current request."""
+    _priority.set(priority)
+
+
+def current_priority() -> Priority:
+    return _resolve(_priority.get())
+
+
+def estimate_tokens(chain: LLMChain, inputs: Dict[str, Any], completion_tokens: int = 500) -> int:
+    """Tokens a chain call counts against the provider limit: the prompt plus the completion allowance."""
+    prompt = chain.prompt.format_prompt(**inputs).to_string()
+    return count_tokens(prompt) + (getattr(chain.llm, "max_tokens", None) or completion_tokens)
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"LLM budget exhausted, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Budget of per_minute units refilled continuously, unlimited when per_minute is 0."""
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        if self.capacity > 0:
+            self.wait_time(0)
+            self.level -= amount
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: Priority
+    sequence: int
+    tokens: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    queued: float = field(compare=False)
+
+
+class LLMScheduler:
+    """Admits LLM calls within requests and tokens per minute budgets, highest priority first.
+
+    Calls that fit the budget start right away, the others wait in a priority queue.
+    A call is rejected with Overloaded instead of queued when the queue of its
+    priority is full or its estimated wait exceeds max_wait, and a queued call that
+    is still waiting after max_wait gives up the same way. Batch calls have nobody
+    waiting for an answer, they wait as long as needed, up to the request deadline.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0, max_queue: int = 100, max_wait: float = 10.0) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.queue: List[_Waiter] = []
+        self._sequence = itertools.count()
+        self._wake = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def _wait_time(self, requests: int, tokens: int) -> float:
+        return max(self.requests.wait_time(requests), self.tokens.wait_time(tokens))
+
+    def _take(self, tokens: int) -> None:
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+    def _clamp(self, tokens: int) -> int:
+        # A single call larger than the whole budget would never fit otherwise
+        return min(tokens, int(self.tokens.capacity)) if self.tokens.capacity > 0 else tokens
+
+    def try_acquire(self, tokens: int) -> bool:
+        """Take budget for a call estimated at tokens if it fits right away, without queueing."""
+        tokens = self._clamp(tokens)
+        if any(not waiter.future.done() for waiter in self.queue) or self._wait_time(1, tokens) > 0:
+            return False
+        self._take(tokens)
+        label = current_priority().name.lower()
+        LLM_ADMISSIONS.inc(priority=label, result="admitted")
+        LLM_QUEUE_SECONDS.observe(0.0, priority=label)
+        return True
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait until a call estimated at tokens fits the budget."""
+        if self.try_acquire(tokens):
+            return
+        priority = current_priority()
+        label = priority.name.lower()
+        tokens = self._clamp(tokens)
+
+        max_wait = self.max_wait if priority == Priority.INTERACTIVE else stage_timeout(None)
+        ahead = [waiter for waiter in self.queue if waiter.priority <= priority and not waiter.future.done()]
+        wait = self._wait_time(len(ahead) + 1, sum(waiter.tokens for waiter in ahead) + tokens)
+        if sum(1 for waiter in ahead if waiter.priority == priority) >= self.max_queue or (max_wait is not None and wait > max_wait):
+            LLM_ADMISSIONS.inc(priority=label, result="shed")
+            raise Overloaded(retry_after=max(wait, 1.0))
+
+        waiter = _Waiter(priority, next(self._sequence), tokens, asyncio.get_running_loop().create_future(), time.monotonic())
+        heapq.heappush(self.queue, waiter)
+        self._update_depth()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wake.set()
+        try:
+            await asyncio.wait_for(waiter.future, max_wait)
+        except asyncio.TimeoutError:
+            LLM_ADMISSIONS.inc(priority=label, result="timeout")
+            raise Overloaded(retry_after=max(max_wait, 1.0)) from None
+        finally:
+            self._update_depth()
+        LLM_ADMISSIONS.inc(priority=label, result="admitted")
+        LLM_QUEUE_SECONDS.observe(time.monotonic() - waiter.queued, priority=label)
+
+    async def _dispatch(self) -> None:
+        while True:
+            # Waiters that timed out or were cancelled are dropped when they reach the head
+            while self.queue and self.queue[0].future.done():
+                heapq.heappop(self.queue)
+            if not self.queue:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            head = self.queue[0]
+            wait = self._wait_time(1, head.tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(self.queue)
+            self._take(head.tokens)
+            head.future.set_result(None)
+
+    def _update_depth(self) -> None:
+        for priority in Priority:
+            depth = sum(1 for waiter in self.queue if waiter.priority == priority and not waiter.future.done())
+            LLM_QUEUE_DEPTH.set(depth, priority=priority.name.lower())
+
+    async def close(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
@@ -0,0 +1,39 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Tuple, TypeVar
+
+from app.resilience import detached_task, stage_timeout
+from app.scheduler import SharedPriority, set_priority
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Deduplicates concurrent calls: callers using the same key await one shared task
+
+    The task does not inherit the deadline of the caller that started it, each caller
+    waits for it until its own deadline, and it runs with the most urgent priority
+    of the callers waiting for it.
+    """
+
+    def __init__(self) -> None:
+        self._tasks: Dict[str, Tuple[asyncio.Task, SharedPriority]] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        flight = self._tasks.get(key)
+        if flight is None:
+            priority = SharedPriority()
+
+            async def run() -> T:
+                set_priority(priority)
+                return await fn()
+
+            flight = (detached_task(run()), priority)
+            self._tasks[key] = flight
+            flight[0].add_done_callback(lambda _: self._tasks.pop(key, None))
+        task, priority = flight
+        priority.join()
+        # Shielded so a cancelled or timed out caller does not cancel the work the others are waiting for
+        return await asyncio.wait_for(asyncio.shield(task), stage_timeout(None))
+
+    def __len__(self) -> int:
+        return len(self._tasks)
@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import aiohttp
+import SPARQLWrapper
+
+from app.metrics import SPARQL_SECONDS
+from app.resilience import CircuitBreaker, stage_timeout
+
+LINDAS_ENDPOINT = "https://lindas.admin.ch/query"
+
+ACCEPT_HEADERS = {
+    SPARQLWrapper.JSON: "application/sparql-results+json,application/json",
+    SPARQLWrapper.N3: "text/turtle,application/turtle,text/n3,application/n-triples",
+    SPARQLWrapper.TURTLE: "text/turtle,application/turtle",
+}
+
+
+@dataclass
+class SparqlResponse:
+    body: Any
+    etag: Optional[str] = None
+    not_modified: bool = False
+
+
+class SparqlClient:
+    """Asyncio SPARQL client sharing one keep-alive connection pool"""
+
+    def __init__(
+        self,
+        endpoint: str = LINDAS_ENDPOINT,
+        max_connections: int = 20,
+        max_concurrency: int = 10,
+        timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        breaker: Optional[CircuitBreaker] = None,
+    ) -> None:
+        self.endpoint = endpoint
+        self.max_connections = max_connections
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.breaker = breaker
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def fetch(self, query: str, return_format: str = SPARQLWrapper.JSON, etag: Optional[str] = None) -> SparqlResponse:
+        """Run query; when etag is given and the endpoint answers 304, body is None.
+
+        The request timeout is shortened to the deadline of the current request, and
+        fails right away with CircuitOpen while the endpoint keeps failing.
+        """
+        headers = {"Accept": ACCEPT_HEADERS[return_format]}
+        if etag:
+            headers["If-None-Match"] = etag
+        if self.breaker is not None:
+            self.breaker.check()
+        options = {}
+        timeout = stage_timeout(self.timeout.total)
+        # aiohttp treats a zero timeout as no timeout at all
+        if timeout is not None and timeout <= 0:
+            raise asyncio.TimeoutError("Request deadline passed before the SPARQL request was sent")
+        deadline_bound = timeout is not None and timeout < self.timeout.total
+        if deadline_bound:
+            options["timeout"] = aiohttp.ClientTimeout(total=timeout, connect=self.timeout.connect)
+        async with self._semaphore:
+            started = time.perf_counter()
+            status = "error"
+            try:
+                async with self._get_session().post(self.endpoint, data={"query": query}, headers=headers, **options) as response:
+                    status = response.status
+                    if response.status == 304:
+                        result = SparqlResponse(body=None, etag=etag, not_modified=True)
+                    else:
+                        response.raise_for_status()
+                        if return_format == SPARQLWrapper.JSON:
+                            body = await response.json(content_type=None)
+                        else:
+                            body = await response.text()
+                        result = SparqlResponse(body=body, etag=response.headers.get("ETag"))
+            except aiohttp.ClientResponseError as e:
+                # Rejected queries are not a sign of an unhealthy endpoint
+                self._record(e.status < 500)
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # Nor is running out of the time the caller had left
+                if not deadline_bound:
+                    self._record(False)
+                raise
+            finally:
+                SPARQL_SECONDS.observe(time.perf_counter() - started, status=status)
+        self._record(True)
+        return result
+
+    def _record(self, healthy: bool) -> None:
+        if self.breaker is not None:
+            if healthy:
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+
+    async def query(self, query: str, return_format: str = SPARQLWrapper.JSON) -> Any:
+        """Run query and return parsed JSON for JSON results, text otherwise."""
+        return (await self.fetch(query, return_format=return_format)).body
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+_client: Optional[SparqlClient] = None
+
+
+def get_client() -> SparqlClient:
+    global _client
+    if _client is None:
+        _client = SparqlClient()
+    return _client
+
+
+def set_client(client: SparqlClient) -> None:
+    global _client
+    _client = client
+
+
+class _BackgroundLoop:
+    """Event loop in a daemon thread, so sync callers (and notebooks with a running loop) can await."""
+
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self.client: Optional[SparqlClient] = None
+
+    def run(self, coro_fn, *args) -> Any:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, daemon=True).start()
+                self.client = SparqlClient()
+        return asyncio.run_coroutine_threadsafe(coro_fn(self.client, *args), self._loop).result()
+
+
+_background = _BackgroundLoop()
+
+
+def run_query_sync(query: str, return_format: str = SPARQLWrapper.JSON) -> Any:
+    return _background.run(SparqlClient.query, query, return_format)
@@ -0,0 +1,141 @@
+import logging
+import re
+import threading
+from typing import FrozenSet, List, Optional
+
+from rdflib import Graph, URIRef
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.algebra import traverse
+from rdflib.plugins.sparql.parserutils import CompValue
+
+from app.cache import DocumentCache
+from app.compact import KNOWN_PREFIXES, _split_namespace
+from app.execute import PROLOGUE, STRING_LITERAL, extract_query
+
+logger = logging.getLogger(__name__)
+
+AGGREGATE = re.compile(r"\b(COUNT|SUM|AVG|MIN|MAX)\s*\(", re.IGNORECASE)
+ALIASED_AGGREGATE = re.compile(
+    r"\(\s*(COUNT|SUM|AVG|MIN|MAX)\s*\(\s*(?:DISTINCT\s+)?(\?\w+|\*)\s*\)\s+AS\s+\?(\w+)\s*\)", re.IGNORECASE
+)
+SELECT_CLAUSE = re.compile(r"\bSELECT\b(.*?)(?=\bWHERE\b|\{)", re.IGNORECASE | re.DOTALL)
+IRI = re.compile(r"<[^<>\s]*>")
+PREFIX_DECLARATION = re.compile(r"\bPREFIX\s+([\w\-.]*):", re.IGNORECASE)
+PREFIXED_NAME = re.compile(r"(?<![\w?$:])([A-Za-z][\w\-.]*)?:(?=[A-Za-z_\d])")
+YEAR_VARIABLE = r"\?\w*year\w*"
+COMPARISON = r"(?:=|!=|<=|>=|<|>)"
+GYEAR_LITERAL = r'"\d{4}"\^\^(?:xsd:gYear|<http://www\.w3\.org/2001/XMLSchema#gYear>)'
+YEAR_VALUE = r'(?:"[^"]*"(?:\^\^(?:[\w\-]*:[\w\-]+|<[^>]*>))?|\d+)'
+YEAR_COMPARISONS = (
+    re.compile(rf"{YEAR_VARIABLE}\s*{COMPARISON}\s*({YEAR_VALUE})", re.IGNORECASE),
+    re.compile(rf"({YEAR_VALUE})\s*{COMPARISON}\s*{YEAR_VARIABLE}", re.IGNORECASE),
+)
+# Only values that look like a year or date are checked, so e.g. ?year_count > 3 passes
+YEAR_LIKE = re.compile(r'"?\d{4}(?:-\d\d){0,2}(?:"|\b)')
+YEAR_FUNCTION_COMPARISON = re.compile(rf"\bYEAR\s*\(\s*\?\w+\s*\)\s*{COMPARISON}", re.IGNORECASE)
+VOCABULARY_NAMESPACES = frozenset(KNOWN_PREFIXES.values())
+
+# The pyparsing based SPARQL parser keeps state in the grammar and is not thread safe
+_parser_lock = threading.Lock()
+
+
+def clean_query(text: str) -> str:
+    """Drop code fences and explanatory text around a generated query (rules 1-3)."""
+    query = extract_query(text)
+    start = re.search(r"^\s*(PREFIX|BASE|SELECT|ASK|CONSTRUCT|DESCRIBE)\b", query, re.IGNORECASE | re.MULTILINE)
+    return query[start.start():].strip() if start else query
+
+
+def _without_literals(query: str) -> str:
+    return IRI.sub("<>", STRING_LITERAL.sub('""', query))
+
+
+def check_prefixes(query: str) -> List[str]:
+    body = _without_literals(query)
+    declared = set(PREFIX_DECLARATION.findall(body))
+    used = set(PREFIXED_NAME.findall(PROLOGUE.sub("", body)))
+    return [f"Prefix '{prefix}:' is used but not declared" for prefix in sorted(used - declared)]
+
+
+def check_aggregations(query: str) -> List[str]:
+    errors = []
+    body = STRING_LITERAL.sub('""', query)
+    select_spans = [match.span(1) for match in SELECT_CLAUSE.finditer(body)]
+    for match in AGGREGATE.finditer(body):
+        if not any(start <= match.start() < end for start, end in select_spans):
+            errors.append(f"{match.group(1).upper()} is used outside of the SELECT clause; aggregate in SELECT and refer to its alias instead")
+    for start, end in select_spans:
+        clause = body[start:end]
+        aliased = ALIASED_AGGREGATE.findall(clause)
+        if len(aliased) < len(AGGREGATE.findall(clause)):
+            errors.append("Aggregations in SELECT have to be written as (FUNC(?a) AS ?func_a)")
+        for function, variable, alias in aliased:
+            expected = f"{function.lower()}_{variable.lstrip('?')}" if variable != "*" else None
+            if expected and alias != expected:
+                errors.append(f"Alias of {function.upper()}({variable}) should be ?{expected}, not ?{alias}")
+    return errors
+
+
+def check_year_filters(query: str) -> List[str]:
+    errors = []
+    for pattern in YEAR_COMPARISONS:
+        for value in pattern.findall(query):
+            if YEAR_LIKE.match(value) and not re.fullmatch(GYEAR_LITERAL, value):
+                year = re.sub(r"\D", "", value)[:4] or "2020"
+                errors.append(f'Year is compared with {value}; use a gYear literal such as "{year}"^^xsd:gYear')
+    if YEAR_FUNCTION_COMPARISON.search(query):
+        errors.append("Compare years extracted from dates through BIND(STRDT(STR(YEAR(?date)), xsd:gYear) AS ?year)")
+    return errors
+
+
+def document_terms(n3: str) -> FrozenSet[URIRef]:
+    """All IRIs in one N3 document."""
+    graph = Graph()
+    try:
+        graph.parse(data=n3, format="turtle")
+    except Exception:
+        logger.warning("Failed to parse cube metadata for validation")
+        return frozenset()
+    return frozenset(term for triple in graph for term in triple if isinstance(term, URIRef))
+
+
+def known_terms(*n3_documents: str, documents: Optional[DocumentCache] = None) -> FrozenSet[URIRef]:
+    """All IRIs in the cube sample and dimension labels, parsed once per document when documents is given."""
+    terms = set()
+    for n3 in n3_documents:
+        terms.update(documents.get("terms", n3, document_terms) if documents is not None else document_terms(n3))
+    return frozenset(terms)
+
+
+def _predicates(algebra) -> List[URIRef]:
+    predicates = []
+
+    def visit(node):
+        if isinstance(node, CompValue) and node.name == "BGP":
+            predicates.extend(predicate for _, predicate, _ in node.triples if isinstance(predicate, URIRef))
+
+    traverse(algebra, visitPost=visit)
+    return predicates
+
+
+def validate_query(query: str, cube_and_sample: str = "", dimensions_triplets: str = "", documents: Optional[DocumentCache] = None) -> List[str]:
+    """Problems found in a generated query, checked locally without calling the endpoint.
+
+    Besides SPARQL syntax, this checks the rules of the query generation prompt and
+    that predicates outside of common vocabularies appear in the cube metadata.
+    """
+    errors = check_prefixes(query) + check_aggregations(query) + check_year_filters(query)
+    if errors:
+        return errors
+    try:
+        with _parser_lock:
+            prepared = prepareQuery(query)
+    except Exception as e:
+        return [f"Syntax error: {e}"]
+
+    terms = known_terms(cube_and_sample, dimensions_triplets, documents=documents) if cube_and_sample or dimensions_triplets else None
+    if terms:
+        for predicate in dict.fromkeys(_predicates(prepared.algebra)):
+            if predicate not in terms and _split_namespace(str(predicate)) not in VOCABULARY_NAMESPACES:
+                errors.append(f"Predicate <{predicate}> does not exist in this cube")
+    return errors
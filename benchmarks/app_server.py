@@ -0,0 +1,29 @@
+"""The API as run by benchmarks/run.py, in its own process so its memory is measured alone.
+
+Usage: python -m benchmarks.app_server PORT TRACE_PATH
+
+Request traces (app.metrics log lines) are written to TRACE_PATH, one JSON object per line.
+"""
+import logging
+import sys
+
+import uvicorn
+
+
+def main() -> None:
+    port, trace_path = int(sys.argv[1]), sys.argv[2]
+    from app.main import app
+    logging.getLogger().setLevel(logging.WARNING)
+
+    traces = logging.getLogger("app.metrics")
+    traces.setLevel(logging.INFO)
+    traces.propagate = False
+    handler = logging.FileHandler(trace_path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    traces.addHandler(handler)
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""Offline benchmark of the API against recorded LINDAS and OpenAI responses.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run --requests 200 --concurrency 16 --output result.json
+    python -m benchmarks.run --baseline result.json --max-regression 0.2
+
+No network access is needed: LINDAS and OpenAI are replaced by benchmarks/stub_server.py.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import signal
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.stub_server import FIXTURES, create_stub_app
+
+ROOT = Path(__file__).resolve().parent.parent
+CUBE = "<https://environment.ld.admin.ch/foen/ubd0104/3>"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies: List[float]) -> dict:
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "mean_ms": round(1000 * sum(latencies) / len(latencies), 2),
+        "p50_ms": round(1000 * percentile(latencies, 0.50), 2),
+        "p95_ms": round(1000 * percentile(latencies, 0.95), 2),
+        "p99_ms": round(1000 * percentile(latencies, 0.99), 2),
+    }
+
+
+def stage_latencies(trace_path: Path) -> Dict[str, List[float]]:
+    """Durations in seconds of every pipeline stage span in the request traces logged by the app."""
+    stages: Dict[str, List[float]] = {}
+    for line in trace_path.read_text().splitlines():
+        try:
+            trace = json.loads(line)
+        except ValueError:
+            continue
+        for span in trace.get("spans", []) if isinstance(trace, dict) else []:
+            stages.setdefault(span["stage"], []).append(span["duration_ms"] / 1000)
+    return stages
+
+
+def _request_body(endpoint: str, question: str) -> dict:
+    if endpoint == "/query":
+        return {"question": question, "cube": CUBE}
+    return {"question": question}
+
+
+async def _drive(base_url: str, args: argparse.Namespace) -> dict:
+    questions = json.loads((FIXTURES / "questions.json").read_text())
+    latencies: Dict[str, List[float]] = {endpoint: [] for endpoint in args.endpoint}
+    errors: Dict[str, int] = {endpoint: 0 for endpoint in args.endpoint}
+    queue: asyncio.Queue = asyncio.Queue()
+    for number in range(args.requests):
+        question = questions[number % len(questions)]
+        if not args.repeat_questions:
+            # A unique suffix defeats the question cache, so every request runs the full pipeline
+            question = f"{question} (#{number})"
+        queue.put_nowait((args.endpoint[number % len(args.endpoint)], question))
+
+    async def worker(session: aiohttp.ClientSession) -> None:
+        while not queue.empty():
+            endpoint, question = queue.get_nowait()
+            started = time.perf_counter()
+            async with session.post(base_url + endpoint, json=_request_body(endpoint, question)) as response:
+                await response.read()
+                if response.status != 200:
+                    errors[endpoint] += 1
+                    continue
+            latencies[endpoint].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(worker(session) for _ in range(args.concurrency)))
+        duration = time.perf_counter() - started
+        async with session.get(base_url + "/cache") as response:
+            cache_stats = await response.json()
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        "duration_s": round(duration, 3),
+        "requests": args.requests,
+        "errors": sum(errors.values()),
+        "throughput_rps": round(completed / duration, 2),
+        "endpoints": {endpoint: {**summarize(values), "errors": errors[endpoint]} for endpoint, values in latencies.items()},
+        "cache": cache_stats,
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    stub_port, api_port = _free_port(), _free_port()
+    stub_app = create_stub_app(
+        llm_latency=args.llm_latency,
+        token_latency=args.token_latency,
+        sparql_latency=args.sparql_latency,
+    )
+    stub_runner = web.AppRunner(stub_app)
+    await stub_runner.setup()
+    await web.TCPSite(stub_runner, "127.0.0.1", stub_port).start()
+
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_API_BASE": f"http://127.0.0.1:{stub_port}/v1",
+        "SPARQL_ENDPOINT": f"http://127.0.0.1:{stub_port}/query",
+        # Responses persisted by earlier runs would hide the LLM calls being measured
+        "LLM_CACHE_PATH": "",
+    }
+    trace_path = Path(tempfile.mkstemp(suffix=".jsonl")[1])
+    # The API runs in a child process, so its peak memory is not mixed with the stub's and the client's
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "benchmarks.app_server", str(api_port), str(trace_path), cwd=ROOT, env=env,
+    )
+    base_url = f"http://127.0.0.1:{api_port}"
+
+    try:
+        await _wait_until_up(base_url, server)
+        result = await _drive(base_url, args)
+    finally:
+        if server.returncode is None:
+            server.send_signal(signal.SIGINT)
+        await server.wait()
+        await stub_runner.cleanup()
+
+    result["config"] = {
+        key: getattr(args, key)
+        for key in ("requests", "concurrency", "endpoint", "repeat_questions", "llm_latency", "token_latency", "sparql_latency")
+    }
+    result["upstream"] = dict(stub_app["stats"])
+    result["stages"] = {stage: summarize(values) for stage, values in sorted(stage_latencies(trace_path).items())}
+    trace_path.unlink()
+    # The API server is the only child process; ru_maxrss is reported in kilobytes on Linux
+    result["memory"] = {"max_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}
+    return result
+
+
+async def _wait_until_up(base_url: str, server: asyncio.subprocess.Process, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if server.returncode is not None:
+                raise RuntimeError(f"API server exited with status {server.returncode}")
+            try:
+                async with session.get(base_url + "/") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientConnectionError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError("API server did not start")
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> List[str]:
+    """Return the regressions of result against baseline that exceed max_regression.
+
+    Endpoint latencies and pipeline stage latencies are compared.
+    """
+    regressions = []
+    for section in ("endpoints", "stages"):
+        for name, current in result[section].items():
+            previous = baseline.get(section, {}).get(name)
+            if not previous or not current.get("count") or not previous.get("count"):
+                continue
+            for metric in ("p50_ms", "p95_ms", "p99_ms"):
+                change = (current[metric] - previous[metric]) / previous[metric] if previous[metric] else 0.0
+                print(f"{name} {metric}: {previous[metric]} -> {current[metric]} ({change:+.1%})", file=sys.stderr)
+                if change > max_regression:
+                    regressions.append(f"{name} {metric} regressed by {change:.1%}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--endpoint", action="append", choices=["/", "/cube", "/query"],
+                        help="endpoints to call in round robin (default: /)")
+    parser.add_argument("--repeat-questions", action="store_true", help="reuse fixture questions so caches are hit")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="stub LLM time to first token in seconds")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="stub LLM delay between streamed chunks")
+    parser.add_argument("--sparql-latency", type=float, default=0.05, help="stub LINDAS response time in seconds")
+    parser.add_argument("--output", help="write the JSON result to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON result of a previous run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="fail when a latency percentile is this much slower than the baseline")
+    args = parser.parse_args()
+    args.endpoint = args.endpoint or ["/"]
+
+    result = asyncio.run(run(args))
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        regressions = compare(result, json.loads(Path(args.baseline).read_text()), args.max_regression)
+        if regressions:
+            print("\n".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def _load_fixtures() -> dict:
+    return {
+        "catalog": (FIXTURES / "catalog.ttl").read_text(),
+        "sample": (FIXTURES / "sample.ttl").read_text(),
+        "dimensions": (FIXTURES / "dimensions.ttl").read_text(),
+        "completions": json.loads((FIXTURES / "completions.json").read_text()),
+    }
+
+
+def _completion_kind(messages: list) -> str:
+    text = " ".join(message.get("content") or "" for message in messages)
+    return "query_generation" if "SPARQL query generator" in text else "cube_selection"
+
+
+def _usage(messages: list, completion: str, seen_prefixes: set) -> dict:
+    prompt_tokens = sum(len(message.get("content") or "") for message in messages) // 4
+    completion_tokens = len(completion) // 4
+    # Like the provider, report everything before the last message as cached once it has been seen
+    prefix = json.dumps(messages[:-1])
+    cached_tokens = sum(len(message.get("content") or "") for message in messages[:-1]) // 4 if prefix in seen_prefixes else 0
+    seen_prefixes.add(prefix)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": cached_tokens},
+    }
+
+
+def create_stub_app(llm_latency: float = 0.0, token_latency: float = 0.0, sparql_latency: float = 0.0) -> web.Application:
+    """LINDAS and OpenAI stand-in replaying recorded responses from benchmarks/fixtures.
+
+    LINDAS: POST /query answers the three fetch_* CONSTRUCT queries with recorded N3.
+    OpenAI: POST /v1/chat/completions answers with the recorded completion for the
+    prompt kind, streamed in small chunks when requested, or as a function call
+    when functions are given.
+    """
+    fixtures = _load_fixtures()
+    stats = {"sparql_requests": 0, "llm_requests": 0}
+    seen_prefixes: set = set()
+
+    async def sparql(request: web.Request) -> web.Response:
+        stats["sparql_requests"] += 1
+        query = (await request.post())["query"]
+        await asyncio.sleep(sparql_latency)
+        if "dct:creator" in query:
+            body = fixtures["catalog"]
+        elif "SAMPLE(" in query:
+            body = fixtures["sample"]
+        elif "sh:in" in query:
+            body = fixtures["dimensions"]
+        else:
+            return web.json_response({"head": {"vars": []}, "results": {"bindings": []}})
+        return web.Response(text=body, content_type="text/turtle")
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        stats["llm_requests"] += 1
+        payload = await request.json()
+        messages = payload["messages"]
+        completion = fixtures["completions"][_completion_kind(messages)]
+        await asyncio.sleep(llm_latency)
+
+        if payload.get("functions"):
+            # Structured cube selection, answered with the cube of the recorded selection
+            arguments = json.dumps({"cubes": [{"cube": completion.strip(), "score": 0.9}]})
+            return web.json_response({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": payload.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": None,
+                        "function_call": {"name": payload["functions"][0]["name"], "arguments": arguments},
+                    },
+                    "finish_reason": "stop",
+                }],
+                "usage": _usage(messages, arguments, seen_prefixes),
+            })
+
+        if not payload.get("stream"):
+            return web.json_response({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": payload.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": completion},
+                    "finish_reason": "stop",
+                }],
+                "usage": _usage(messages, completion, seen_prefixes),
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for start in range(0, len(completion), 16):
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": payload.get("model", "stub"),
+                "choices": [{"index": 0, "delta": {"content": completion[start:start + 16]}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(token_latency)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app["stats"] = stats
+    app.router.add_post("/query", sparql)
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
@@ -1,4 +1,6 @@
 import re
+import sys
+from pathlib import Path
 
 import SPARQLWrapper
 from langchain.callbacks.base import BaseCallbackHandler
@@ -6,14 +8,12 @@ from langchain.chains import LLMChain
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts.chat import ChatPromptTemplate
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from app.sparql import run_query_sync
+
 
 def run_query(query: str, return_format: str = SPARQLWrapper.JSON):
-    sparql = SPARQLWrapper.SPARQLWrapper(endpoint="https://lindas.admin.ch/query")
-    sparql.setReturnFormat(return_format)
-    sparql.setHTTPAuth(SPARQLWrapper.DIGEST)
-    sparql.setMethod(SPARQLWrapper.POST)
-    sparql.setQuery(query)
-    return sparql.queryAndConvert()
+    return run_query_sync(query, return_format=return_format)
 
 
 def fetch_cubes_descriptions() -> str:
@@ -47,8 +47,7 @@ def fetch_cubes_descriptions() -> str:
         }
     """
 
-    raw_result = run_query(cubes_query, return_format=SPARQLWrapper.N3)
-    return raw_result.decode()
+    return run_query(cubes_query, return_format=SPARQLWrapper.N3)
 
 def fetch_dimensions() -> str:
     with open('/home/magdalena/zazuko/llm-playground/dimensions_short.txt', 'r') as file:
@@ -194,8 +193,7 @@ def fetch_cube_sample(cube: str) -> str:
         }}
     """
 
-    raw_result = run_query(query, return_format=SPARQLWrapper.N3)
-    return raw_result.decode()
+    return run_query(query, return_format=SPARQLWrapper.N3)
 
 
 def fetch_dimensions_triplets(cube: str) -> str:
@@ -233,5 +231,4 @@ def fetch_dimensions_triplets(cube: str) -> str:
         }}
     """
 
-    raw_result = run_query(query, return_format=SPARQLWrapper.N3)
-    return raw_result.decode()
+    return run_query(query, return_format=SPARQLWrapper.N3)